@@ -1,10 +1,29 @@
 # AGBinator: Draft Edition
 
 import argparse
-import glob
-import itertools
+import array
+import collections
+import csv
+import fnmatch
+import hashlib
+import io
+import json
+import mmap
+import multiprocessing
 import os
-import re
+import pickle
+import sys
+import time
+
+try:
+    from re import _parser as sre_parse
+except ImportError:  # before Python 3.11
+    import sre_parse
+
+from agbsignatures import (PADDING_MARGIN, expand_patterns, find_padding, find_signature, has_signature, load_signatures,
+                           normalize_thumb, parse_shard, search_signature, shard_filenames)
+
+SIGNATURES = load_signatures()
 
 
 def is_rom_address(address):
@@ -47,40 +66,159 @@ def make_full_product_id(product_id):
         return "AGB-{0:<4}-{1}".format(product_id.split("\0")[0], decode_country_code(product_id[3]))
 
 
-def agbinator_scan_mp2k(rom):
-    m4a_functions = {}
+# longer than any signature and version string, so a match never falls between two segments
+AGBINATOR_SEGMENT_OVERLAP = 0x100
 
-    song_start_patterns = [
-        b"\x00\xb5\x00\x04\x07\x4b\x08\x49\x40\x0b\x40\x18\x82\x88\x51\x00\x89\x18\x89\x00\xc9\x18\x0a\x68\x01\x68\x10\x1c",
-        b"\x00\xb5\x00\x04\x07\x4a\x08\x49\x40\x0b\x40\x18\x83\x88\x59\x00\xc9\x18\x89\x00\x89\x18\x0a\x68\x01\x68\x10\x1c"]
-    for pattern in song_start_patterns:
-        offset = rom.find(pattern)
-        if offset != -1:
-            m4a_functions["m4aSongNumStart"] = offset
-            break
-
-    sound_init_patterns = [
-        b"\xf0\xb5\x47\x46\x80\xb4\x18\x48\x02\x21\x49\x42\x08\x40\x17\x49\x17\x4a",
-        b"\x70\xb5\x14\x48\x02\x21\x49\x42\x08\x40\x13\x49\x13\x4a"]
-    for pattern in sound_init_patterns:
-        offset = rom.find(pattern)
-        if offset != -1:
-            m4a_functions["m4aSoundInit"] = offset
-            break
-
-    sound_sync_patterns = [
-        b'\x00\xb5\x18\x48\x02\x68\x10\x68\x17\x49\x40\x18\x01\x28\x26\xd8\x10\x79\x01\x38\x11\x79\x10\x71\x10\x79\x00\x06\x00\x28\x1e\xdc',
-        b'\xa4\x48\x00\x68\xa4\x4a\x03\x68\x9b\x1a\x01\x2b\x11\xd8\x01\x79\x01\x39\x01\x71\x0d\xdc\xc1\x7a\x01\x71\x06\x4a\x91\x68\xc9\x01',
-        b'\xa6\x48\x00\x68\xa6\x4a\x03\x68\x9b\x1a\x01\x2b\x0e\xd8\x01\x79\x01\x39\x01\x71\x0a\xdc\xc1\x7a\x01\x71\x00\x20\xb6\x21\x09\x02',
-        b'\xa6\x48\x00\x68\xa6\x4a\x03\x68\x9b\x1a\x01\x2b\x11\xd8\x01\x79\x01\x39\x01\x71\x0d\xdc\xc1\x7a\x01\x71\x06\x4a\x91\x68\xc9\x01',
-        b'\xa8\x48\x00\x68\xa8\x4a\x03\x68\x9b\x1a\x01\x2b\x18\xd8\x01\x79\x01\x39\x01\x71\x14\xdc\xc1\x7a\x01\x71\x0a\x4a\x91\x68\xc9\x01',
-        b'\xaa\x48\x00\x68\xaa\x4a\x03\x68\x9b\x1a\x01\x2b\x18\xd8\x01\x79\x01\x39\x01\x71\x14\xdc\xc1\x7a\x01\x71\x0a\x4a\x91\x68\xc9\x01',
-        b'\xe6\x48\x00\x68\xe6\x4a\x03\x68\x9a\x42\x0e\xd1\x01\x79\x01\x39\x01\x71\x0a\xdc\xc1\x7a\x01\x71\x00\x20\xb6\x21\x09\x02\x03\x4a']
-    for pattern in sound_sync_patterns:
-        offset = rom.find(pattern)
+# every find/search on a ParallelRom is a pool round trip (about 0.5 ms), which only pays
+# off when a sequential search of the ROM takes several times longer
+AGBINATOR_PARALLEL_MIN_SIZE = 0x400000
+
+segment_key = None
+segment_buffer = None
+
+
+def open_segment_buffer(key):
+    # Each worker maps the file itself, the ROM is never copied through the pipe. The pool
+    # outlives a single ROM, so the mapping is replaced whenever another file (or a rewritten
+    # one, e.g. under --watch) is searched.
+    global segment_key, segment_buffer
+    if key == segment_key:
+        return
+    if segment_buffer is not None:
+        segment_buffer.close()
+    with open(key[0], "rb") as f:
+        segment_buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    segment_key = key
+
+
+def find_segment(key, sub, start, end):
+    open_segment_buffer(key)
+    return segment_buffer.find(sub, start, end)
+
+
+def search_segment(key, pattern, start, end):
+    open_segment_buffer(key)
+    match_result = pattern.search(segment_buffer, start, end)
+    return match_result.start() if match_result else -1
+
+
+class ParallelRom:
+    # Stands in for the ROM bytes: every find/search is split into overlapping
+    # segments that the pool workers search, and the earliest hit is kept,
+    # which is exactly what a sequential search would return.
+
+    def __init__(self, rom, pool, num_segments, key):
+        self.rom = rom
+        self.pool = pool
+        self.key = key
+        self.segment_size = max(-(-len(rom) // num_segments), AGBINATOR_SEGMENT_OVERLAP)
+
+    def __len__(self):
+        return len(self.rom)
+
+    def __getitem__(self, key):
+        return self.rom[key]
+
+    def segments(self, start, end, overlap):
+        return [(segment_start, min(segment_start + self.segment_size + overlap, end))
+                for segment_start in range(start, end, self.segment_size)]
+
+    def find(self, sub, start=0, end=None):
+        end = len(self.rom) if end is None else end
+        overlap = max(AGBINATOR_SEGMENT_OVERLAP, len(sub) - 1)
+        offsets = self.pool.starmap(find_segment, [(self.key, sub, segment_start, segment_end)
+                                                   for segment_start, segment_end in self.segments(start, end, overlap)])
+        offsets = [offset for offset in offsets if offset != -1]
+        return min(offsets) if offsets else -1
+
+    def search(self, pattern):
+        # a match must fit in the overlap to be found across two segments, so a pattern
+        # without an upper bound on its length (e.g. ".*?\x00") is searched as a whole
+        width = sre_parse.parse(pattern.pattern, pattern.flags).getwidth()[1]
+        if width >= sre_parse.MAXREPEAT:
+            return pattern.search(self.rom)
+
+        overlap = max(AGBINATOR_SEGMENT_OVERLAP, width - 1)
+        offsets = self.pool.starmap(search_segment, [(self.key, pattern, segment_start, segment_end)
+                                                     for segment_start, segment_end in self.segments(0, len(self.rom), overlap)])
+        offsets = [offset for offset in offsets if offset != -1]
+        # the segment only located the match, take the groups from the whole ROM
+        return pattern.match(self.rom, min(offsets)) if offsets else None
+
+
+# hit offsets are counted in this many equal windows of the ROM, the densest are probed first
+AGBINATOR_HINT_WINDOWS = 64
+AGBINATOR_HINT_PROBES = 4
+
+
+def load_hints(path):
+    try:
+        with open(path, encoding="utf-8") as f:
+            hints = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    return hints["windows"] if hints.get("num_windows") == AGBINATOR_HINT_WINDOWS else {}
+
+
+def save_hints(path, hints):
+    try:
+        write_atomically(path, json.dumps({"num_windows": AGBINATOR_HINT_WINDOWS, "windows": hints}).encode())
+    except OSError as e:
+        print("{0}: {1}".format(path, e), file=sys.stderr)
+
+
+class HintedRom:
+    # Stands in for the ROM bytes like ParallelRom. find() and search() behave exactly
+    # as on the bytes; find() also counts where each pattern was found (relative to the
+    # ROM size). find_any() is only used by has_signature(), where any hit will do: it
+    # probes the windows where the pattern was found most often first, and scans the
+    # whole ROM only when they all miss.
+
+    def __init__(self, rom, hints):
+        self.rom = rom
+        self.hints = hints
+
+    def __len__(self):
+        return len(self.rom)
+
+    def __getitem__(self, key):
+        return self.rom[key]
+
+    def windows(self, key, overlap):
+        counts = self.hints.get(key)
+        if not counts:
+            return []
+        windows = sorted((window for window, count in enumerate(counts) if count), key=lambda window: -counts[window])
+        return [(window * len(self.rom) // AGBINATOR_HINT_WINDOWS,
+                 min(len(self.rom), (window + 1) * len(self.rom) // AGBINATOR_HINT_WINDOWS + overlap))
+                for window in windows[:AGBINATOR_HINT_PROBES]]
+
+    def record(self, key, offset):
+        counts = self.hints.setdefault(key, [0] * AGBINATOR_HINT_WINDOWS)
+        counts[offset * AGBINATOR_HINT_WINDOWS // len(self.rom)] += 1
+
+    def find(self, sub, start=0, end=None):
+        offset = self.rom.find(sub, start, end)
         if offset != -1:
-            m4a_functions["m4aSoundSync"] = offset
-            break
+            self.record(sub.hex(), offset)
+        return offset
+
+    def find_any(self, sub):
+        for window_start, window_end in self.windows(sub.hex(), len(sub) - 1):
+            offset = self.rom.find(sub, window_start, window_end)
+            if offset != -1:
+                self.record(sub.hex(), offset)
+                return offset
+        return self.find(sub)
+
+    def search(self, pattern):
+        # version strings are reported as found, so regexes always take the first match
+        return self.rom.search(pattern) if hasattr(self.rom, "search") else pattern.search(self.rom)
+
+
+def agbinator_scan_mp2k(rom, thumb_rom=None):
+    m4a_functions = [function for function in ("m4aSongNumStart", "m4aSoundInit", "m4aSoundSync")
+                     if has_signature(rom, SIGNATURES, "mp2k", function, thumb_rom)]
 
     if not m4a_functions:
         return None
@@ -98,8 +236,7 @@ def agbinator_scan_mp2k(rom):
 
 
 def agbinator_scan_gax(rom):
-    gax_signature_pattern = re.compile(br"GAX Sound Engine v?(\d)\.(\d{1,3})([A-Za-z\-]*)")
-    match_result = gax_signature_pattern.search(rom)
+    match_result = search_signature(rom, SIGNATURES, "gax", "version")
     if not match_result:
         return None
 
@@ -113,49 +250,10 @@ def agbinator_scan_musyx(rom):
     musyx = {"function": {}}
     # TODO: MusyX - improve speed
 
-    snd_init_offset = rom.find(
-        b'\x70\xb5\x05\x1c\x0e\x1c\x30\x68\x03\x21\x08\x40\x00\x28\x00\xd0\xb4\xe0\x70\x68\x08\x40\x00\x28\x00\xd0\xaf\xe0\xb0\x68\x08\x40')
-    if snd_init_offset == -1:
-        snd_init_offset = rom.find(
-            b'\xf0\xb5\x47\x46\x80\xb4\x05\x1c\x0e\x1c\x90\x46\x1f\x1c\x00\x2a\x00\xd1\xc1\xe0\x00\x2f\x00\xd1\xbe\xe0\x30\x68\x03\x21\x08\x40')
-    if snd_init_offset != -1:
-        musyx["function"]["snd_Init"] = {"address": to_address(snd_init_offset)}
-
-    snd_handle_intermediate_offset = rom.find(
-        b'\x00\x20\x81\x46\x00\x24\x2a\x48\x03\x68\x4a\x46\x91\x00\x18\x1c\x18\x30\x42\x18\x11\x68\x40\x20\x08\x40\x00\x28\x19\xd0\x41\x20')
-    snd_handle_offset = snd_handle_intermediate_offset - 0x2c if snd_handle_intermediate_offset >= 0x2c else -1
-    if snd_handle_offset != -1:
-        musyx["function"]["snd_Handle"] = {"address": to_address(snd_handle_offset)}
-
-    snd_do_sample_offset = rom.find(
-        b'\xf0\xb5\x57\x46\x4e\x46\x45\x46\xe0\xb4\x85\xb0\x31\x4e\x35\x68\x28\x78\x00\x28\x00\xd1\xaa\xe0\x2f\x1c\xd0\x37\x38\x68\x00\x90')
-    if snd_do_sample_offset == -1:
-        snd_do_sample_offset = rom.find(
-            b'\xf0\xb5\x57\x46\x4e\x46\x45\x46\xe0\xb4\x85\xb0\x36\x4d\x2c\x68\x20\x7a\x00\x28\x00\xd1\xb4\xe0\x27\x1c\xd8\x37\x38\x68\x00\x90')
-    if snd_do_sample_offset != -1:
-        musyx["function"]["snd_DoSample"] = {"address": to_address(snd_do_sample_offset)}
-
-    snd_start_song_offset = rom.find(
-        b'\xf0\xb5\x57\x46\x4e\x46\x45\x46\xe0\xb4\x05\x1c\x39\x4a\x13\x68\x88\x21\x49\x00\x58\x18\x00\x68\x81\x69\x40\x18\x00\x68\xa8\x42')
-    if snd_start_song_offset == -1:
-        snd_start_song_offset = rom.find(
-            b'\xf0\xb5\x57\x46\x4e\x46\x45\x46\xe0\xb4\x04\x1c\x3a\x4a\x13\x68\x8c\x21\x49\x00\x58\x18\x00\x68\x81\x69\x40\x18\x00\x68\xa0\x42')
-    if snd_start_song_offset != -1:
-        musyx["function"]["snd_StartSong"] = {"address": to_address(snd_start_song_offset)}
-
-    snd_resume_song_offset = rom.find(
-        b'\x06\x48\x00\x68\x8c\x21\x49\x00\x40\x18\x00\x68\x39\x31\x42\x18\x11\x78\x01\x29\x04\xd0\x00\x20\x06\xe0\x00\x00')
-    if snd_resume_song_offset == -1:
-        snd_resume_song_offset = rom.find(
-            b'\x06\x48\x00\x68\x90\x21\x49\x00\x40\x18\x00\x68\x31\x31\x42\x18\x11\x78\x01\x29\x04\xd0\x00\x20\x06\xe0\x00\x00')
-    if snd_resume_song_offset != -1:
-        musyx["function"]["snd_ResumeSong"] = {"address": to_address(snd_resume_song_offset)}
-
-    snd_get_sample_working_set_size_offset = rom.find(
-        b'\xf0\xb5\x57\x46\x4e\x46\x45\x46\xe0\xb4\x82\xb0\x04\x1c\x0e\x1c\x00\x2e\x01\xd1\x00\x20\xdc\xe0\xa2\x78\x10\x01\x80\x18\x80\x00')
-    if snd_get_sample_working_set_size_offset != -1:
-        musyx["function"]["snd_GetSampleWorkingSetSize"] = {
-            "address": to_address(snd_get_sample_working_set_size_offset)}
+    for function in SIGNATURES["signatures"]["musyx"]:
+        offset, signature = find_signature(rom, SIGNATURES, "musyx", function)
+        if offset != -1:
+            musyx["function"][function] = {"address": to_address(offset - signature["entry_offset"])}
 
     return {
         "driver_name": "MusyX Audio Tools",
@@ -164,27 +262,24 @@ def agbinator_scan_musyx(rom):
 
 
 def agbinator_scan_krawall(rom):
-    krawall_rcs_pattern = re.compile(b"\\$Id: Krawall.*?\x00")
-    match_result = krawall_rcs_pattern.search(rom)
+    match_result = search_signature(rom, SIGNATURES, "krawall", "version")
     if match_result:
         return {
             "driver_name": "Krawall",
             "driver_version": match_result.group().split(b"\x00")[0].decode("iso-8859-1")
         }
-        else:
-            offset = rom.find(b'\x73\x5c\xa7\xae\x73\xe3\x64\xc9\x73\x97\x28\xe4\x73')
-            if offset == -1:
-                return None
+    else:
+        if not has_signature(rom, SIGNATURES, "krawall", "driver"):
+            return None
 
-        return {
-            "driver_name": "Krawall",
-            "driver_version": ""
-         }
+    return {
+        "driver_name": "Krawall",
+        "driver_version": ""
+    }
 
 
 def agbinator_scan_gbamodplay(rom):
-    gbamod_signature_offset = rom.find(b'Logik State')
-    if gbamod_signature_offset == -1:
+    if not has_signature(rom, SIGNATURES, "gbamodplay", "driver"):
         return None
 
     return {
@@ -194,37 +289,19 @@ def agbinator_scan_gbamodplay(rom):
 
 
 def agbinator_scan_kcej(rom):
-    offset = rom.find(b'\x50\x18\x01\x88\x80\x20\x80\x01\x08\x40\x00\x04\x05\x0c\x00\x2d')
-    if offset != -1 and offset >= 12:
-        return {
-            "driver_name": "Konami(KCEJ)/GUN",
-            "driver_version": "Late"  # Yu-Gi-Oh! World Championship Tournament 2004 etc.
-        }
-
-    offset = rom.find(b'\xf0\x7b\x48\x43\x04\x13\x30\x88\x00\x19\x38\x80\x70\x88\x78\x80\xb0\x78\xf8\x80')
-    if offset != -1 and offset >= 0x498:
-        return {
-            "driver_name": "Konami(KCEJ)/GUN",
-            "driver_version": "Middle"  # Yu-Gi-Oh! Worldwide Edition: Stairway to the Destined Duel etc.
-        }
-
-    offset = rom.find(b'\x08\x0d\x98\x80\x1d\x60\x60\x42\x30\x80\x80\x20\xc0\x01\x02\x40\x00\x2a')
-    if offset != -1 and offset >= 0x64:
-        return {
-            "driver_name": "Konami(KCEJ)/GUN",
-            "driver_version": "Early"  # Get Backers - Jigoku no Scaramouche
-        }
+    # Late, Middle and Early variants, the newest one is tried first
+    offset, signature = find_signature(rom, SIGNATURES, "kcej", "driver")
+    if offset == -1:
+        return None
 
-    return None
+    return {
+        "driver_name": "Konami(KCEJ)/GUN",
+        "driver_version": signature["version"]
+    }
 
 
-def agbinator_scan_natsume(rom):
-    offset = rom.find(b'\x42\x18\x11\x88\x0a\x48\x81\x42\x01\xd8\x48\x1c\x10\x80\x18\x1c')
-    if offset == -1:
-        offset = rom.find(b'\x42\x18\x11\x88\x0b\x48\x81\x42\x01\xd8\x48\x1c\x10\x80\x18\x1c')
-        if offset == -1:
-            offset = rom.find(b'\x42\x18\x11\x88\x0c\x48\x81\x42\x01\xd8\x48\x1c\x10\x80\x18\x1c')
-    if offset == -1 or offset < 10:
+def agbinator_scan_natsume(rom, thumb_rom=None):
+    if not has_signature(rom, SIGNATURES, "natsume", "driver", thumb_rom):
         return None
 
     return {
@@ -234,8 +311,7 @@ def agbinator_scan_natsume(rom):
 
 
 def agbinator_scan_quintet(rom):
-    offset = rom.find(b'\xf0\xb5\x4f\x46\x46\x46\xc0\xb4\x00\x20\x80\x46\x1e\x4e\x20\x21\x89\x19\x89\x46\x00\x27\x30\x1c\x1c\x30\x3d\x18\x29\x68\x01\x20')
-    if offset == -1:
+    if not has_signature(rom, SIGNATURES, "quintet", "driver"):
         return None
 
     return {
@@ -245,8 +321,7 @@ def agbinator_scan_quintet(rom):
 
 
 def agbinator_scan_gstyle(rom):
-    offset = rom.find(b'\x00\xb5\x01\x1c\x05\x48\x89\x00\x00\x68\x40\x18\x01\x68\x40\x18\x04\x30\x00\x21')
-    if offset == -1:
+    if not has_signature(rom, SIGNATURES, "gstyle", "driver"):
         return None
 
     return {
@@ -256,11 +331,7 @@ def agbinator_scan_gstyle(rom):
 
 
 def agbinator_scan_webfoot(rom):
-    offset = rom.find(b'\x70\xb5\x01\x25\x85\x70\x05\x70\x00\x22\x42\x70\xc1\x60\x04\x1c\x48\x7c\xe0\x70\xd0\x43\x20\x61\x00\x20\x43\x00\x1b\x18\x5b\x01')
-    if offset == -1:
-        offset = rom.find(
-            b'\x70\xb5\x10\x4c\x01\x26\xa6\x70\x05\x1c\x00\x20\xe6\x70\x60\x70\xe5\x60\x68\x7a\x20\x71\x70\x42\xe0\x80') # Legacy of Goku
-    if offset == -1:
+    if not has_signature(rom, SIGNATURES, "webfoot", "driver"):
         return None
 
     return {
@@ -270,11 +341,12 @@ def agbinator_scan_webfoot(rom):
 
 
 def agbinator_scan_rare(rom):
-    offset = rom.find(b'\xf0\xb5\x43\x46\x4c\x46\x55\x46\x5e\x46\x67\x46\xf8\xb4')
+    # the epilogue is searched after the first prologue, so both are searched in order
+    offset, _ = find_signature(rom, SIGNATURES, "rare", "prologue")
     if offset == -1:
         return None
 
-    offset_temp = rom.find(b'\x49\x08\x60\xf8\xbc\x98\x46\xa1\x46\xaa\x46\xb3\x46\xbc\x46\xf0\xbc', offset + 14)
+    offset_temp, _ = find_signature(rom, SIGNATURES, "rare", "epilogue", offset + 14)
     if offset_temp == -1:
         return None
 
@@ -286,16 +358,14 @@ def agbinator_scan_rare(rom):
 
 def agbinator_scan_scm3lt(rom):
     # Not very appropriate. The following scan detects patterns outside of the driver's code.
-    signature_pattern = re.compile(b"SCM3LT Ver.*?\x00")
-    match_result = signature_pattern.search(rom)
+    match_result = search_signature(rom, SIGNATURES, "scm3lt", "version")
     if match_result:
         return {
             "driver_name": "SCM3LT",
             "driver_version": match_result.group().split(b"\x00")[0].decode("iso-8859-1")
         }
     else:
-        offset = rom.find(b'\x82\x72\x82\x62\x82\x6c\x82\x52\x82\x6b\x82\x73') # Shift_JIS full-width "SCM3LT"
-        if offset == -1:
+        if not has_signature(rom, SIGNATURES, "scm3lt", "driver"):
             return None
 
     return {
@@ -305,8 +375,7 @@ def agbinator_scan_scm3lt(rom):
 
 
 def agbinator_scan_torus(rom):
-    offset = rom.find(b'\x0b\x1c\x18\x78\xc1\x08\x24\xd3\x04\x22\x12\x06\xbc\x32\x98\x69\x40\x08')
-    if offset == -1:
+    if not has_signature(rom, SIGNATURES, "torus", "driver"):
         return None
 
     return {
@@ -316,9 +385,7 @@ def agbinator_scan_torus(rom):
 
 
 def agbinator_scan_brownie_brown(rom):
-    # Scan for SoundMain fragments written in ARM
-    offset = rom.find(b'\x02\x00\x51\xe1\x00\x10\xa0\x43\x02\x10\x41\x50\x00\x10\xc0\xe5\xa1\x22\xa0\xe1\x02\x32\xa0\xe1\x02\x20\x83\xe0')
-    if offset == -1:
+    if not has_signature(rom, SIGNATURES, "brownie_brown", "driver"):
         return None
 
     return {
@@ -328,8 +395,7 @@ def agbinator_scan_brownie_brown(rom):
 
 
 def agbinator_scan_alphadream(rom):
-    offset = rom.find(b'\x78\x01\x20\10\x43\x08\x70\x31\x68\xc9\x18\x??\x19\x0a\x78\xfd\x20\x10\x40\x08\x70\x0e\x48')
-    if offset == -1:
+    if not has_signature(rom, SIGNATURES, "alphadream", "driver"):
         return None
 
     return {
@@ -339,41 +405,37 @@ def agbinator_scan_alphadream(rom):
 
 
 def agbinator_scan_quickthunder(rom):
-    offset = rom.find(b'\x80\x00\x37\x49\x09\x18\x37\x4a\x4c\x78\x01\x34\xd3\x7f\x9c\x42')
-    if offset == -1:
+    if not has_signature(rom, SIGNATURES, "quickthunder", "driver"):
         return None
 
     return {
         "driver_name": "QuickThunder",
         "driver_version": ""
     }
-    
+
 
 def agbinator_scan_engine_software(rom):
-    offset = rom.find(b'\x1c\x35\x22\x35\x29\x35\x2f\x35\x35\x35\x3b\x35\x41\x35\x47\x35\x4d\x35\x54')
-    if offset == -1:
+    if not has_signature(rom, SIGNATURES, "engine_software", "driver"):
         return None
 
     return {
         "driver_name": "Engine Software",
         "driver_version": ""
     }
-    
+
 
 def agbinator_scan_gbass(rom):
-    offset = rom.find(b'\x04\xcc\x00\x00\x04\x0a\x4b\x0b\x49\x0b\x4c\x0c\x4d\x68\x78\x0c\x4b\x00\x28\x00\xd0')
-    if offset == -1:
+    if not has_signature(rom, SIGNATURES, "gbass", "driver"):
         return None
 
     return {
         "driver_name": "GBASS/Paragon 5",
         "driver_version": ""
     }
-    
+
 
 def agbinator_scan_sonix(rom):
-    offset = rom.find(b'\x10\x21\x82\x78\x0a\x43\x82\x70\x??\xe7')
-    if offset == -1:
+    if not has_signature(rom, SIGNATURES, "sonix", "driver"):
         return None
 
     return {
@@ -381,67 +443,61 @@ def agbinator_scan_sonix(rom):
         "driver_version": ""
     }
 
+
 def agbinator_scan_apex(rom):
-    offset = rom.find(b'\xb2\x42\x00\xdb\x1f\x22\x5d\x01\x4b\x19\x91\x02\x5d\x18\x??\x46\x15\x80\x02')
-    if offset == -1:
+    if not has_signature(rom, SIGNATURES, "apex", "driver"):
         return None
 
-    offset_temp = rom.find(b'\xb2\x42\x09\xdA\x8b\x68\x44\x46\x1b\x1b\x1b\x12')
-    if offset_temp == -1:
+    if not has_signature(rom, SIGNATURES, "apex", "driver_check"):
         return None
 
     return {
         "driver_name": "Apex",
         "driver_version": ""
     }
-    
+
 
 def agbinator_scan_bit_managers(rom):
-    offset = rom.find(b'\xc9\x0e\x2b\x0f\x8d\x0f\xee\x0f\x4f\x10')
-    if offset == -1:
+    if not has_signature(rom, SIGNATURES, "bit_managers", "driver"):
         return None
 
     return {
         "driver_name": "Bit Managers",
         "driver_version": ""
     }
-    
+
 
 def agbinator_scan_paul_tonge(rom):
-    offset = rom.find(b'\x09\x01\xc8\x18\x84\x46\x64\x46\x24\x34')
-    if offset == -1:
+    if not has_signature(rom, SIGNATURES, "paul_tonge", "driver"):
         return None
 
     return {
         "driver_name": "Paul Tonge",
         "driver_version": ""
     }
-    
+
 
 def agbinator_scan_mark_cooksey(rom):
-    offset = rom.find(b'\x9d\x07\x6b\xca\x23\x78\xc7\x12\x59\x9c\xdb\x17\x4f\x84\xb6\xe5\x12\x3c\x64')
-    if offset == -1:
+    if not has_signature(rom, SIGNATURES, "mark_cooksey", "driver"):
         return None
 
     return {
         "driver_name": "Mark Cooksey",
         "driver_version": ""
     }
-    
+
 
 def agbinator_scan_ugba_player(rom):
-    signature_pattern = re.compile(b"UGBA Player Copyright 2001 Thalamus Interactive Ltd.\x00")
-    match_result = signature_pattern.search(rom)
+    match_result = search_signature(rom, SIGNATURES, "ugba_player", "version")
     if match_result:
         return {
             "driver_name": "UGBA Player",
             "driver_version": match_result.group().split(b"\x00")[0].decode("iso-8859-1")
         }
     else:
-        offset = rom.find(b'\x30\x80\xbd\x18\x72\xfd\xff\xeb\x83\xfd\xff\xeb\x30\x40\xbd\xe8\xb2\xfc\xff\xea\x70\x40\x2d\xe9\c42\xf3\xff\xeb\x3d\xf8')
-        if offset == -1:
+        if not has_signature(rom, SIGNATURES, "ugba_player", "driver"):
             return None
-        
+
     return {
         "driver_name": "UGBA Player",
         "driver_version": ""
@@ -449,8 +505,7 @@ def agbinator_scan_ugba_player(rom):
 
 
 def agbinator_scan_ubisoft_milan(rom):
-    offset = rom.find(b'\x02\xf0\xb5\x4f\x46\x46\x46\xc0\xb4\x83\xb0\x81\x46\x0e\x1c\x77\x1c\x71\x78\x78\x78\x00\x02\x01\x43')
-    if offset == -1:
+    if not has_signature(rom, SIGNATURES, "ubisoft_milan", "driver"):
         return None
 
     return {
@@ -459,165 +514,556 @@ def agbinator_scan_ubisoft_milan(rom):
     }
 
 
-def agbinator(filename):
+AGBINATOR_SCANNERS = [
+    agbinator_scan_mp2k,
+    agbinator_scan_gax,
+    agbinator_scan_musyx,
+    agbinator_scan_krawall,
+    agbinator_scan_gbamodplay,
+    agbinator_scan_kcej,
+    agbinator_scan_natsume,
+    agbinator_scan_quintet,
+    agbinator_scan_gstyle,
+    agbinator_scan_webfoot,
+    agbinator_scan_rare,
+    agbinator_scan_scm3lt,
+    agbinator_scan_torus,
+    agbinator_scan_brownie_brown,
+    agbinator_scan_alphadream,
+    agbinator_scan_quickthunder,
+    agbinator_scan_engine_software,
+    agbinator_scan_gbass,
+    agbinator_scan_sonix,
+    agbinator_scan_apex,
+    agbinator_scan_bit_managers,
+    agbinator_scan_paul_tonge,
+    agbinator_scan_mark_cooksey,
+    agbinator_scan_ugba_player,
+    agbinator_scan_ubisoft_milan
+]
+
+
+def read_rom(filename):
     size = os.path.getsize(filename)
     if size < 0xc0 or size > 0x2000000:
         raise ValueError("Input too small/large")
 
     with open(filename, "rb") as f:
-        rom = f.read()
-
-        internal_name = rom[0xa0:0xac].split(b'\x00', 1)[0].decode()
-        product_id = rom[0xac:0xb0].decode()
-        full_product_id = make_full_product_id(product_id)
-        result = {
-            "filename": os.path.basename(filename),
-            "internal_name": internal_name,
-            "product_id": product_id,
-            "full_product_id": full_product_id
-        }
-
-        match_result = agbinator_scan_mp2k(rom)
-        if match_result:
-            result |= match_result
-            return result
-
-        match_result = agbinator_scan_gax(rom)
-        if match_result:
-            result |= match_result
-            return result
-
-        match_result = agbinator_scan_musyx(rom)
-        if match_result:
-            result |= match_result
-            return result
+        return f.read()
 
-        match_result = agbinator_scan_krawall(rom)
-        if match_result:
-            result |= match_result
-            return result
-
-        match_result = agbinator_scan_gbamodplay(rom)
-        if match_result:
-            result |= match_result
-            return result
-
-        match_result = agbinator_scan_kcej(rom)
-        if match_result:
-            result |= match_result
-            return result
 
-        match_result = agbinator_scan_natsume(rom)
-        if match_result:
-            result |= match_result
-            return result
+def agbinator_header(filename, rom):
+    internal_name = rom[0xa0:0xac].split(b'\x00', 1)[0].decode()
+    product_id = rom[0xac:0xb0].decode()
+    full_product_id = make_full_product_id(product_id)
+    return {
+        "path": filename,
+        "filename": os.path.basename(filename),
+        "internal_name": internal_name,
+        "product_id": product_id,
+        "full_product_id": full_product_id
+    }
 
-        match_result = agbinator_scan_quintet(rom)
-        if match_result:
-            result |= match_result
-            return result
 
-        match_result = agbinator_scan_gstyle(rom)
-        if match_result:
-            result |= match_result
-            return result
+# scanners that also accept a Thumb normalized view of the ROM
+AGBINATOR_THUMB_SCANNERS = {
+    agbinator_scan_mp2k,
+    agbinator_scan_natsume
+}
 
-        match_result = agbinator_scan_webfoot(rom)
-        if match_result:
-            result |= match_result
-            return result
 
-        match_result = agbinator_scan_rare(rom)
+def agbinator_scan(rom, thumb_rom=None):
+    # scanners are ordered by priority, the first match wins
+    for scanner in AGBINATOR_SCANNERS:
+        if thumb_rom is not None and scanner in AGBINATOR_THUMB_SCANNERS:
+            match_result = scanner(rom, thumb_rom)
+        else:
+            match_result = scanner(rom)
         if match_result:
-            result |= match_result
-            return result
+            return match_result
+    return None
 
-        match_result = agbinator_scan_scm3lt(rom)
-        if match_result:
-            result |= match_result
-            return result
 
-        match_result = agbinator_scan_torus(rom)
-        if match_result:
-            result |= match_result
-            return result
+def read_scanned_rom(filename):
+    # the header and padding fields of the result, and the part of the ROM the scanners search
+    rom = read_rom(filename)
+    result = agbinator_header(filename, rom)
 
-        match_result = agbinator_scan_brownie_brown(rom)
-        if match_result:
-            result |= match_result
-            return result
+    padding_offset, padding_byte = find_padding(rom)
+    result["padding_size"] = len(rom) - padding_offset
+    result["padding_byte"] = "%02X" % padding_byte if padding_byte is not None else ""
+    return result, rom[:padding_offset + PADDING_MARGIN]
 
-        match_result = agbinator_scan_alphadream(rom)
-        if match_result:
-            result |= match_result
-            return result
 
-        match_result = agbinator_scan_quickthunder(rom)
-        if match_result:
-            result |= match_result
-            return result
+def agbinator(filename, thumb=False, jobs=1, hints=None, pool=None):
+    # with jobs > 1, pool should be a multiprocessing.Pool(jobs) shared by every ROM of the
+    # run, starting one per ROM costs more than the search it splits for most ROMs
+    if jobs > 1 and pool is None:
+        with multiprocessing.Pool(jobs) as pool:
+            return agbinator(filename, thumb, jobs, hints, pool)
 
-        match_result = agbinator_scan_engine_software(rom)
-        if match_result:
-            result |= match_result
-            return result
+    stat = os.stat(filename)
+    result, rom = read_scanned_rom(filename)
+    thumb_rom = normalize_thumb(rom) if thumb else None
 
-        match_result = agbinator_scan_gbass(rom)
-        if match_result:
-            result |= match_result
-            return result
+    if hints is not None:
+        thumb_rom = HintedRom(thumb_rom, hints) if thumb_rom is not None else None
 
-        match_result = agbinator_scan_sonix(rom)
-        if match_result:
-            result |= match_result
-            return result
+    if jobs > 1 and len(rom) >= AGBINATOR_PARALLEL_MIN_SIZE:
+        parallel_rom = ParallelRom(rom, pool, jobs, (filename, stat.st_size, stat.st_mtime_ns))
+        match_result = agbinator_scan(HintedRom(parallel_rom, hints) if hints is not None else parallel_rom, thumb_rom)
+    else:
+        match_result = agbinator_scan(HintedRom(rom, hints) if hints is not None else rom, thumb_rom)
 
-        match_result = agbinator_scan_apex(rom)
-        if match_result:
-            result |= match_result
-            return result
+    if match_result:
+        result |= match_result
+    return result
 
-        match_result = agbinator_scan_bit_managers(rom)
-        if match_result:
-            result |= match_result
-            return result
 
-        match_result = agbinator_scan_paul_tonge(rom)
-        if match_result:
-            result |= match_result
-            return result
+def partial_digest(filename, size, block_size=0x10000):
+    with open(filename, "rb") as f:
+        head = f.read(block_size)
+        f.seek(max(size - block_size, len(head)))
+        tail = f.read(block_size)
+    return hashlib.blake2b(head + tail).digest()
 
-        match_result = agbinator_scan_mark_cooksey(rom)
-        if match_result:
-            result |= match_result
-            return result
 
-        match_result = agbinator_scan_ugba_player(rom)
-        if match_result:
-            result |= match_result
-            return result
+def full_digest(filename, block_size=0x100000):
+    digest = hashlib.blake2b()
+    with open(filename, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            digest.update(block)
+    return digest.digest()
+
+
+def find_duplicates(entries):
+    # Yields (index, filename, original) where original is an earlier file with the same
+    # content, or None. Files are compared by size, then by a digest of their head and
+    # tail, and only then by a full digest, which is computed lazily.
+    entries = [(index, filename, os.stat(filename)) for index, filename in entries]
+    size_counts = {}
+    for _, _, stat in entries:
+        size_counts[stat.st_size] = size_counts.get(stat.st_size, 0) + 1
+
+    seen = {}
+    for index, filename, stat in entries:
+        if size_counts[stat.st_size] < 2:
+            yield index, filename, None
+            continue
+
+        members = seen.setdefault((stat.st_size, partial_digest(filename, stat.st_size)), [])
+        original = None
+        digest = None
+        for member in members:
+            member_filename, member_stat, member_digest = member
+            if (member_stat.st_dev, member_stat.st_ino) == (stat.st_dev, stat.st_ino):
+                original = member_filename
+                break
+
+            if digest is None:
+                digest = full_digest(filename)
+            if member_digest is None:
+                member[2] = member_digest = full_digest(member_filename)
+            if member_digest == digest:
+                original = member_filename
+                break
+
+        if original is None:
+            members.append([filename, stat, digest])
+        yield index, filename, original
+
+
+def snapshot_directory(directory, pattern):
+    # None when the directory itself cannot be listed, e.g. while a network share reconnects
+    snapshot = {}
+    try:
+        with os.scandir(directory) as it:
+            for entry in it:
+                try:
+                    if entry.is_file() and fnmatch.fnmatch(entry.name, pattern):
+                        stat = entry.stat()
+                        snapshot[entry.path] = (stat.st_size, stat.st_mtime_ns)
+                except OSError:
+                    # removed or renamed between the listing and the stat; seen again next time
+                    continue
+    except OSError as e:
+        print("{0}: {1}".format(directory, e), file=sys.stderr, flush=True)
+        return None
+    return snapshot
+
+
+def write_atomically(path, data):
+    # written aside and renamed, so that an interrupted run never leaves a truncated file
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    temporary_path = "%s.%d" % (path, os.getpid())
+    with open(temporary_path, "wb") as f:
+        f.write(data)
+    os.replace(temporary_path, path)
+
+
+def load_watch_state(path):
+    if path is None:
+        return {}
+    try:
+        with open(path, encoding="utf-8") as f:
+            return {filename: tuple(stat) for filename, stat in json.load(f).items()}
+    except (OSError, ValueError, AttributeError, TypeError):
+        return {}
+
+
+def save_watch_state(path, scanned):
+    if path is None:
+        return
+    try:
+        write_atomically(path, json.dumps(scanned).encode())
+    except OSError as e:
+        print("{0}: {1}".format(path, e), file=sys.stderr)
+
+
+def watch_directory(directory, pattern, interval, scan, state_path=None):
+    # Every file is scanned once it is stable, including the ones that were already there
+    # when the watch started, unless the state file recorded it with the same size and mtime.
+    scanned = load_watch_state(state_path)
+    previous = snapshot_directory(directory, pattern) or {}
+    while True:
+        time.sleep(interval)
+        current = snapshot_directory(directory, pattern)
+        if current is None:
+            # keep the last snapshot and the scanned files, and retry on the next interval
+            continue
+        for filename, stat in sorted(current.items()):
+            # a file is scanned once its size and mtime stayed the same for a whole interval
+            if scanned.get(filename) != stat and previous.get(filename) == stat:
+                scan(filename)
+                scanned[filename] = stat
+                # saved right away, a stopped watch then resumes after the last scanned file
+                save_watch_state(state_path, scanned)
+        if scanned.keys() - current.keys():
+            for filename in scanned.keys() - current.keys():
+                del scanned[filename]
+            save_watch_state(state_path, scanned)
+        previous = current
+
+
+def walk_directory(directory, includes, excludes, path, visited=None):
+    # symbolic links to directories are followed, but each directory is walked only once
+    # so that a link back to a parent does not loop
+    visited = set() if visited is None else visited
+    stat = os.stat(directory)
+    if (stat.st_dev, stat.st_ino) in visited:
+        return
+    visited.add((stat.st_dev, stat.st_ino))
+
+    # sorted, so that the order (and the --shard indices) does not depend on the file system
+    with os.scandir(directory) as it:
+        entries = sorted(it, key=lambda entry: entry.name)
+    for entry in entries:
+        if any(fnmatch.fnmatch(entry.name, pattern) for pattern in excludes):
+            continue
+        if entry.is_dir():
+            yield from walk_directory(entry.path, includes, excludes, os.path.join(path, entry.name), visited)
+        elif entry.is_file() and any(fnmatch.fnmatch(entry.name, pattern) for pattern in includes):
+            yield entry.path, os.path.join(path, entry.name)
+
+
+def expand_filenames(patterns, includes, excludes):
+    # yields (filename, path relative to the input root) pairs, see expand_patterns()
+    for filename, path in expand_patterns(patterns):
+        if os.path.isdir(filename):
+            yield from walk_directory(filename, includes, excludes, path)
+        elif not any(fnmatch.fnmatch(os.path.basename(filename), pattern) for pattern in excludes):
+            yield filename, path
+
+
+RESULT_FIELDS = ["path", "filename", "internal_name", "product_id", "full_product_id", "driver_name", "driver_version",
+                 "padding_size", "padding_byte"]
+
+
+def format_result(result):
+    return ("{0}\t{1}\t{2}\t{3}\t{4}"
+            .format(result.get("internal_name"),
+                    result.get("full_product_id"),
+                    result.get("driver_name", ""),
+                    result.get("driver_version", ""),
+                    result.get("filename")))
+
+
+# the store is corpus data rather than a cache, so it lives in the user's data directory
+AGBINATOR_STORE_PATH = os.path.join(os.environ.get("XDG_DATA_HOME") or os.path.join(os.path.expanduser("~"), ".local", "share"),
+                                    "agbinator", "results.pickle")
+
+# results scanned between two saves of the store and the hints in a batch run
+AGBINATOR_SAVE_INTERVAL = 100
+
+# bump whenever the stored columns change, an older store is then started over
+AGBINATOR_STORE_FORMAT = 1
+
+SUMMARY_FIELDS = {"driver": "driver_name", "version": "driver_version", "region": "region"}
+
+
+class ResultStore:
+    # Results of every scanned ROM, kept as one column per field instead of one
+    # dict per ROM. Strings that repeat across ROMs (product id, driver, version,
+    # region) are interned: the column holds an index into the table of values.
+    INTERNED_FIELDS = ("product_id", "driver_name", "driver_version", "region")
+
+    def __init__(self, state=None):
+        if state is None:
+            state = {
+                "paths": [],
+                "internal_names": [],
+                "padding_sizes": array.array("L"),
+                "strings": {field: [""] for field in self.INTERNED_FIELDS},
+                "columns": {field: array.array("L") for field in self.INTERNED_FIELDS}
+            }
+        self.state = state
+        self.rows = {path: row for row, path in enumerate(state["paths"])}
+        self.indexes = {field: {value: index for index, value in enumerate(strings)}
+                        for field, strings in state["strings"].items()}
+
+    def __len__(self):
+        return len(self.state["paths"])
+
+    def is_consistent(self):
+        # every column holds one entry per ROM, and every index points into its table
+        state = self.state
+        if not set(state["columns"]) == set(state["strings"]) == set(self.INTERNED_FIELDS):
+            return False
+        lengths = {len(state["internal_names"]), len(state["padding_sizes"])} | {len(column) for column in state["columns"].values()}
+        return lengths == {len(self)} and all(max(column, default=0) < len(state["strings"][field])
+                                              for field, column in state["columns"].items())
+
+    def intern(self, field, value):
+        index = self.indexes[field].get(value)
+        if index is None:
+            index = self.indexes[field][value] = len(self.state["strings"][field])
+            self.state["strings"][field].append(value)
+        return index
+
+    def add(self, result):
+        # a ROM scanned again replaces its previous row
+        path = os.path.abspath(result["path"])
+        product_id = result["product_id"]
+        values = {
+            "product_id": product_id,
+            "driver_name": result.get("driver_name", ""),
+            "driver_version": result.get("driver_version", ""),
+            "region": decode_country_code(product_id[3]) if len(product_id) == 4 and product_id[0] != "\0" else ""
+        }
 
-        match_result = agbinator_scan_ubisoft_milan(rom)
-        if match_result:
-            result |= match_result
-            return result
-            
-        return result
+        row = self.rows.get(path)
+        if row is None:
+            row = self.rows[path] = len(self.state["paths"])
+            self.state["paths"].append(path)
+            self.state["internal_names"].append(result["internal_name"])
+            self.state["padding_sizes"].append(result.get("padding_size", 0))
+            for field, value in values.items():
+                self.state["columns"][field].append(self.intern(field, value))
+        else:
+            self.state["internal_names"][row] = result["internal_name"]
+            self.state["padding_sizes"][row] = result.get("padding_size", 0)
+            for field, value in values.items():
+                self.state["columns"][field][row] = self.intern(field, value)
+
+    def summary(self, fields):
+        # counts the index tuples, the strings are only looked up once per group
+        columns = [self.state["columns"][SUMMARY_FIELDS[field]] for field in fields]
+        strings = [self.state["strings"][SUMMARY_FIELDS[field]] for field in fields]
+        counts = collections.Counter(zip(*columns))
+        return sorted(((count, [table[index] for table, index in zip(strings, key)]) for key, count in counts.items()),
+                      key=lambda group: (-group[0], group[1]))
+
+
+def load_results(path):
+    try:
+        with open(path, "rb") as f:
+            stored = pickle.load(f)
+        if stored["format"] == AGBINATOR_STORE_FORMAT:
+            store = ResultStore(stored["state"])
+            if store.is_consistent():
+                return store
+    except FileNotFoundError:
+        return ResultStore()
+    except Exception:
+        # a damaged pickle can raise nearly anything
+        pass
+
+    # an unreadable or outdated store is kept aside and a new one is started
+    aside_path = path + ".corrupt"
+    number = 1
+    while os.path.exists(aside_path):
+        aside_path = "%s.corrupt.%d" % (path, number)
+        number += 1
+    try:
+        os.replace(path, aside_path)
+        print("{0}: unreadable result store, moved to {1}".format(path, aside_path), file=sys.stderr)
+    except OSError as e:
+        print("{0}: unreadable result store, not replaced: {1}".format(path, e), file=sys.stderr)
+        raise SystemExit(1)
+    return ResultStore()
+
+
+def save_results(path, store):
+    try:
+        write_atomically(path, pickle.dumps({"format": AGBINATOR_STORE_FORMAT, "state": store.state}, pickle.HIGHEST_PROTOCOL))
+    except OSError as e:
+        print("{0}: {1}".format(path, e), file=sys.stderr)
+
+
+def parse_summary_fields(text):
+    fields = text.split(",")
+    for field in fields:
+        if field not in SUMMARY_FIELDS:
+            raise argparse.ArgumentTypeError("expected a comma separated list of " + ", ".join(SUMMARY_FIELDS))
+    return fields
+
+
+def make_result_writer(output_format, with_index=False, with_header=True):
+    # Every record is flushed on its own so that a consumer can follow a long run. With
+    # an index, each record is prefixed by it and a tab whatever the format, so that
+    # shard outputs merge with "sort -s -n -k1,1 | cut -f2-" into the single-node output
+    # (the csv header carries -1 to stay first).
+    def emit(text, index=None):
+        print("{0}\t{1}".format(index, text) if with_index else text, end="", flush=True)
+
+    if output_format == "ndjson":
+        def write(result, index=None):
+            emit(json.dumps(result, ensure_ascii=False) + "\n", index)
+    elif output_format == "csv":
+        buffer = io.StringIO()
+        writer = csv.DictWriter(buffer, RESULT_FIELDS, restval="")
+
+        def write_row(row, index):
+            buffer.seek(0)
+            buffer.truncate()
+            writer.writerow(row)
+            emit(buffer.getvalue(), index)
+
+        if with_header:
+            write_row(dict(zip(RESULT_FIELDS, RESULT_FIELDS)), -1)
+
+        def write(result, index=None):
+            write_row(result, index)
+    else:
+        def write(result, index=None):
+            emit(format_result(result) + "\n", index)
+    return write
 
 
 def main():
     parser = argparse.ArgumentParser(description="Identify the sound driver from Game Boy Advance ROM.")
-    parser.add_argument('filenames', nargs='+', help='GBA ROM to be parsed')
+    parser.add_argument('filenames', nargs='*', help='GBA ROM to be parsed, directories are walked recursively')
+    parser.add_argument('--include', action='append', metavar='PATTERN',
+                        help='file name pattern to scan while walking directories (default: *.gba)')
+    parser.add_argument('--exclude', action='append', default=[], metavar='PATTERN',
+                        help='file or directory name pattern to skip')
+    parser.add_argument('--format', choices=['tsv', 'ndjson', 'csv'], default='tsv',
+                        help='output format, ndjson and csv carry every field of the result')
+    parser.add_argument('--thumb', action='store_true',
+                        help='match Thumb signatures with PC-relative operands normalized, covering more build variants')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='split each ROM into segments searched by this many worker processes, started once for the whole run')
+    parser.add_argument('--shard', type=parse_shard, metavar='i/N',
+                        help='scan only the i-th of N byte-balanced shards (0-based), prefixing each record with its '
+                             'input index and a tab in every format, so that shard outputs merge into the single-node '
+                             'output with "sort -s -n -k1,1 | cut -f2-"')
+    parser.add_argument('--no-dedup', action='store_true',
+                        help='scan every file even if its content is identical to a file scanned before')
+    parser.add_argument('--hints', metavar='FILE',
+                        help='keep statistics of where each signature was found in FILE, and search those regions '
+                             'first when only the presence of a signature matters')
+    parser.add_argument('--store', default=AGBINATOR_STORE_PATH, metavar='FILE',
+                        help='file collecting the results of every scan, read by --summary '
+                             '(default: $XDG_DATA_HOME/agbinator/results.pickle)')
+    parser.add_argument('--no-store', action='store_true', help='do not add the results to the store')
+    parser.add_argument('--summary', nargs='?', const='driver,version,region', type=parse_summary_fields, metavar='FIELDS',
+                        help='print the number of stored ROMs grouped by FIELDS (default: driver,version,region) '
+                             'instead of scanning')
+    parser.add_argument('--watch', metavar='DIR',
+                        help='keep polling DIR and scan ROMs that are added or changed once they stop growing')
+    parser.add_argument('--watch-pattern', default='*.gba', help='file name pattern for --watch (default: *.gba)')
+    parser.add_argument('--watch-interval', type=float, default=2.0, help='polling interval in seconds for --watch')
+    parser.add_argument('--watch-state', metavar='FILE',
+                        help='remember the files scanned by --watch in FILE, so that a restarted watch skips them '
+                             '(without it, every file in DIR is scanned at startup)')
     args = parser.parse_args()
-
-    for filename in itertools.chain.from_iterable(glob.iglob(pattern) for pattern in args.filenames):
-        result = agbinator(filename)
-        print("{0}\t{1}\t{2}\t{3}\t{4}"
-              .format(result.get("internal_name"),
-                      result.get("full_product_id"),
-                      result.get("driver_name", ""),
-                      result.get("driver_version", ""),
-                      result.get("filename")))
-
-
-main()
+    if args.summary:
+        for count, values in load_results(args.store).summary(args.summary):
+            print("\t".join([str(count)] + values))
+        return
+
+    if not args.watch and not args.filenames:
+        parser.error("the following arguments are required: filenames")
+
+    hints = load_hints(args.hints) if args.hints else None
+    store = None if args.no_store else load_results(args.store)
+
+    def save():
+        if hints is not None:
+            save_hints(args.hints, hints)
+        if store is not None:
+            save_results(args.store, store)
+
+    # one pool for the whole run, its workers map each ROM as it comes
+    pool = multiprocessing.Pool(args.jobs) if args.jobs > 1 else None
+    num_results = 0
+
+    def record(result, index=None):
+        # saved every few results, so that a killed run keeps most of its work
+        nonlocal num_results
+        write(result, index)
+        if store is not None:
+            store.add(result)
+        num_results += 1
+        if num_results % AGBINATOR_SAVE_INTERVAL == 0:
+            save()
+
+    try:
+        if args.watch:
+            def scan(filename):
+                try:
+                    result = agbinator(filename, args.thumb, args.jobs, hints, pool)
+                except (OSError, ValueError) as e:
+                    print("{0}: {1}".format(filename, e), file=sys.stderr, flush=True)
+                    return
+                record(result)
+                # a watch is usually stopped by a signal, so every scan is saved right away
+                save()
+
+            write = make_result_writer(args.format)
+
+            try:
+                watch_directory(args.watch, args.watch_pattern, args.watch_interval, scan, args.watch_state)
+            except KeyboardInterrupt:
+                pass
+            return
+
+        filenames = expand_filenames(args.filenames, args.include or ['*.gba'], args.exclude)
+        if args.shard:
+            entries = shard_filenames(list(filenames), *args.shard)
+            # only the first shard writes the csv header, so that merged outputs carry one
+            write = make_result_writer(args.format, True, args.shard[0] == 0)
+        else:
+            entries = enumerate(filename for filename, _ in filenames)
+            write = make_result_writer(args.format)
+
+        if args.no_dedup:
+            for index, filename in entries:
+                record(agbinator(filename, args.thumb, args.jobs, hints, pool), index)
+            return
+
+        # identical ROMs are scanned once, each copy gets the result under its own name
+        results = {}
+        for index, filename, original in find_duplicates(entries):
+            if original is None:
+                result = results[filename] = agbinator(filename, args.thumb, args.jobs, hints, pool)
+            else:
+                result = results[original] | {"path": filename, "filename": os.path.basename(filename)}
+            record(result, index)
+    finally:
+        save()
+        if pool is not None:
+            pool.terminate()
+
+if __name__ == "__main__":
+    main()
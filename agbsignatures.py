@@ -0,0 +1,292 @@
+# Sound driver signature database shared by agbinator and the tools, along with
+# the helpers they have in common (padding detection, input expansion and --shard).
+#
+# signatures.json lists every signature with its driver, function name and either
+# a hex pattern ("??" for any byte, with an optional bit mask) or a regex. Variants
+# of the same driver/function are tried in file order. A pattern is never matched
+# before min_offset, and it starts entry_offset bytes into the function it identifies.
+
+import argparse
+import glob
+import heapq
+import json
+import os
+import pickle
+import re
+import zlib
+
+SIGNATURES_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "signatures.json")
+
+# bump whenever the compiled form changes, so that stale caches get rebuilt
+COMPILED_FORMAT = 3
+
+
+def make_thumb_tables():
+    # PC-relative encodings: ldr rX, [pc, #imm], add rX, pc, #imm, b<cond>, b and bl.
+    # The register and the immediate/offset bits are cleared, the opcode is kept.
+    high_table = bytearray(range(256))
+    low_mask = bytearray(b'\xff' * 256)
+    for first, last in ((0x48, 0x4f), (0xa0, 0xa7), (0xe0, 0xe7), (0xf0, 0xf7), (0xf8, 0xff)):
+        for byte in range(first, last + 1):
+            high_table[byte] = first
+            low_mask[byte] = 0
+    for byte in range(0xd0, 0xde):  # 0xde is undefined and 0xdf is swi
+        low_mask[byte] = 0
+    return bytes(high_table), bytes(low_mask)
+
+
+THUMB_HIGH_TABLE, THUMB_LOW_MASK = make_thumb_tables()
+
+
+def normalize_thumb(data):
+    # Works on whole halfword lanes at once, data is assumed to be halfword aligned.
+    low = data[0::2]
+    high = data[1::2]
+    mask = high.translate(THUMB_LOW_MASK).ljust(len(low), b'\xff')
+    low = (int.from_bytes(low, "little") & int.from_bytes(mask, "little")).to_bytes(len(low), "little")
+
+    normalized = bytearray(data)
+    normalized[0::2] = low
+    normalized[1::2] = high.translate(THUMB_HIGH_TABLE)
+    return bytes(normalized)
+
+
+def find_thumb(thumb_rom, pattern, start=0, end=None):
+    # a hit on an odd offset straddles two instructions
+    offset = thumb_rom.find(pattern, start, end)
+    while offset != -1 and offset % 2 != 0:
+        offset = thumb_rom.find(pattern, offset + 1, end)
+    return offset
+
+
+def parse_pattern(text):
+    pattern = bytearray()
+    mask = bytearray()
+    for token in text.split():
+        if token == "??":
+            pattern.append(0)
+            mask.append(0)
+        else:
+            pattern.append(int(token, 16))
+            mask.append(0xff)
+    return bytes(pattern), bytes(mask)
+
+
+def compile_signature(entry):
+    signature = {
+        "driver": entry["driver"],
+        "function": entry["function"],
+        "min_offset": entry.get("min_offset", 0),
+        "entry_offset": entry.get("entry_offset", 0),
+        "version": entry.get("version", "")
+    }
+    if "regex" in entry:
+        # kept as source: a pickled re.Pattern is compiled again when it is loaded,
+        # so the cache could not save that work anyway (see signature_regex)
+        signature["regex"] = entry["regex"].encode("iso-8859-1")
+        return signature
+
+    pattern, mask = parse_pattern(entry["pattern"])
+    if "mask" in entry:
+        mask = bytes(a & b for a, b in zip(mask, parse_pattern(entry["mask"])[0]))
+    pattern = bytes(a & b for a, b in zip(pattern, mask))
+    signature["pattern"] = pattern
+
+    if mask.count(0xff) == len(mask):
+        signature["mask"] = None
+        signature["thumb_pattern"] = normalize_thumb(pattern)
+        return signature
+
+    # masked patterns are located by their longest exact run, the rest is verified
+    runs = [m.span() for m in re.finditer(b"\xff+", mask)]
+    start, end = max(runs, key=lambda span: span[1] - span[0])
+    signature["mask"] = mask
+    signature["anchor"] = (start, pattern[start:end])
+    signature["thumb_pattern"] = None
+    return signature
+
+
+def compile_signatures(source):
+    database = {"version": source["version"], "signatures": {}}
+    for entry in source["signatures"]:
+        functions = database["signatures"].setdefault(entry["driver"], {})
+        functions.setdefault(entry["function"], []).append(compile_signature(entry))
+    return database
+
+
+def load_signatures(path=SIGNATURES_PATH):
+    stat = os.stat(path)
+    key = (COMPILED_FORMAT, stat.st_size, stat.st_mtime_ns)
+    cache_path = os.path.join(os.path.dirname(path), "__pycache__", os.path.basename(path) + ".pickle")
+    try:
+        with open(cache_path, "rb") as f:
+            cache = pickle.load(f)
+        if cache["key"] == key:
+            return cache["database"]
+    except (OSError, EOFError, KeyError, TypeError, pickle.UnpicklingError):
+        pass
+
+    with open(path, encoding="utf-8") as f:
+        database = compile_signatures(json.load(f))
+
+    # the cache is only an optimization, a read-only checkout simply goes without it
+    try:
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        temporary_path = "%s.%d" % (cache_path, os.getpid())
+        with open(temporary_path, "wb") as f:
+            pickle.dump({"key": key, "database": database}, f, pickle.HIGHEST_PROTOCOL)
+        os.replace(temporary_path, cache_path)
+    except OSError:
+        pass
+    return database
+
+
+def match_signature(rom, signature, start=0, end=None, thumb_rom=None):
+    start = max(start, signature["min_offset"])
+    if signature["mask"] is None:
+        if thumb_rom is not None:
+            return find_thumb(thumb_rom, signature["thumb_pattern"], start, end)
+        return rom.find(signature["pattern"], start, end)
+
+    pattern = signature["pattern"]
+    mask = signature["mask"]
+    anchor_offset, anchor = signature["anchor"]
+    offset = rom.find(anchor, start + anchor_offset, end)
+    while offset != -1:
+        candidate = offset - anchor_offset
+        window = rom[candidate:candidate + len(pattern)]
+        if len(window) == len(pattern) and all(a & m == p for a, m, p in zip(window, mask, pattern)):
+            return candidate
+        offset = rom.find(anchor, offset + 1, end)
+    return -1
+
+
+def find_signature(rom, database, driver, function, start=0, end=None, thumb_rom=None):
+    # returns the offset of the first variant that matches, and that variant
+    searched = set()
+    for signature in database["signatures"][driver][function]:
+        if thumb_rom is not None and signature["thumb_pattern"] is not None:
+            # variants that only differ in PC-relative operands collapse into one search
+            if signature["thumb_pattern"] in searched:
+                continue
+            searched.add(signature["thumb_pattern"])
+            offset = match_signature(rom, signature, start, end, thumb_rom)
+        else:
+            offset = match_signature(rom, signature, start, end)
+        if offset != -1:
+            return offset, signature
+    return -1, None
+
+
+def has_signature(rom, database, driver, function, thumb_rom=None):
+    # Only tells whether some variant matches. For that any hit will do, so rom may
+    # offer find_any() to return one without looking for the first (see
+    # agbinator.HintedRom). Masked patterns and the ones bound to min_offset are
+    # still searched in order with match_signature().
+    searched = set()
+    for signature in database["signatures"][driver][function]:
+        thumb = thumb_rom is not None and signature["thumb_pattern"] is not None
+        if thumb:
+            # variants that only differ in PC-relative operands collapse into one search
+            if signature["thumb_pattern"] in searched:
+                continue
+            searched.add(signature["thumb_pattern"])
+        view = thumb_rom if thumb else rom
+        if signature["mask"] is None and signature["min_offset"] == 0 and hasattr(view, "find_any"):
+            offset = view.find_any(signature["thumb_pattern"] if thumb else signature["pattern"])
+            if offset == -1:
+                # find_any() ends with a full search, so a miss is final
+                continue
+            if not thumb or offset % 2 == 0:
+                return True
+        if match_signature(rom, signature, thumb_rom=thumb_rom if thumb else None) != -1:
+            return True
+    return False
+
+
+compiled_regexes = {}
+
+
+def signature_regex(signature):
+    # compiled on first use, once per process
+    source = signature["regex"]
+    if source not in compiled_regexes:
+        compiled_regexes[source] = re.compile(source)
+    return compiled_regexes[source]
+
+
+def search_signature(rom, database, driver, function):
+    for signature in database["signatures"][driver][function]:
+        pattern = signature_regex(signature)
+        # rom may also be an object that runs the search itself (see agbinator.ParallelRom)
+        match_result = rom.search(pattern) if hasattr(rom, "search") else pattern.search(rom)
+        if match_result:
+            return match_result
+    return None
+
+
+# Signatures are still searched this far past the padding offset, as one may end with
+# a few bytes that look like padding. Longer than any signature and version string.
+PADDING_MARGIN = 0x100
+
+
+def find_padding(rom, block_size=0x10000):
+    # Dumps are filled up to a power of two with 0xFF or 0x00: compare whole blocks
+    # from the end, then strip the block where the data stops.
+    if not rom or rom[-1] not in (0x00, 0xff):
+        return len(rom), None
+
+    fill = rom[-1:]
+    block = fill * block_size
+    offset = len(rom)
+    while offset >= block_size and rom[offset - block_size:offset] == block:
+        offset -= block_size
+    tail = rom[max(offset - block_size, 0):offset]
+    return offset - len(tail) + len(tail.rstrip(fill)), rom[-1]
+
+
+def glob_root(pattern):
+    # the directory part of a pattern before its first wildcard
+    root = pattern
+    while glob.has_magic(root):
+        root = os.path.dirname(root)
+    return root if os.path.isdir(root) else os.path.dirname(root) or os.curdir
+
+
+def expand_patterns(patterns):
+    # Yields each match with its path relative to the directory part of its pattern,
+    # which stays the same whatever the working directory or mount point. Matches are
+    # sorted, so that the order (and the --shard indices) does not depend on the file system.
+    for pattern in patterns:
+        root = glob_root(pattern)
+        for filename in sorted(glob.iglob(pattern)):
+            yield filename, os.path.relpath(filename, root)
+
+
+def parse_shard(text):
+    m = re.fullmatch(r"(\d+)/(\d+)", text)
+    if not m or int(m.group(2)) == 0 or int(m.group(1)) >= int(m.group(2)):
+        raise argparse.ArgumentTypeError("expected i/N with 0 <= i < N")
+    return int(m.group(1)), int(m.group(2))
+
+
+def shard_filenames(filenames, shard_index, shard_count):
+    # Every node computes the same assignment from the same (filename, relative path)
+    # list: largest files first, ties broken by a hash of the relative path, each going
+    # to the lightest shard.
+    entries = []
+    for index, (filename, path) in enumerate(filenames):
+        path = path.replace(os.sep, "/")
+        entries.append((-os.path.getsize(filename), zlib.crc32(path.encode()), path, index, filename))
+    entries.sort()
+
+    shards = [(0, shard) for shard in range(shard_count)]
+    assigned = []
+    for negative_size, _, _, index, filename in entries:
+        load, shard = heapq.heappop(shards)
+        heapq.heappush(shards, (load - negative_size, shard))
+        if shard == shard_index:
+            assigned.append((index, filename))
+
+    # keep the input order so that shard outputs merge back by index
+    return sorted(assigned)
@@ -2,6 +2,12 @@ import argparse
 import os
 import re
 import struct
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".."))
+from agbsignatures import PADDING_MARGIN, expand_patterns, find_padding, find_signature, load_signatures, parse_shard, shard_filenames
+
+SIGNATURES = load_signatures()
 
 
 def is_rom_address(address):
@@ -62,38 +68,62 @@ def parse_gax_version(rom, offset):
     return version
 
 
-def parse_gax_music_v2(rom, offset):
+def parse_gax_handler(rom, handler_address):
+    if not is_rom_address(handler_address) or handler_address % 4 != 0:
+        return None
+
+    handler_offset = to_offset(handler_address)
+    if handler_offset + 4 >= len(rom):
+        return None
+
+    if struct.unpack_from("<L", rom, handler_offset)[0] == 0:
+        return ()
+    if handler_offset + 0x1c > len(rom):
+        return None
+
+    handler_fields = struct.unpack_from("<LLLLLLL", rom, handler_offset)
+    if not is_rom_address(handler_fields[0]) or not is_rom_address(handler_fields[1]) or not is_rom_address(handler_fields[2]): # mandatory function pointers
+        return None
+    num_linked_handlers = handler_fields[3]
+    if num_linked_handlers > 255:
+        return None
+    return handler_fields
+
+
+def parse_gax_music_v2(rom, offset, handler_cache=None):
     if offset + 4 >= len(rom):
         return None
 
     num_handlers = struct.unpack_from("<L", rom, offset)[0]
-    if num_handlers < 3 or num_handlers > 255:
+    # num_channels shares the low halfword with num_handlers, which rules out more than 32
+    if num_handlers < 3 or num_handlers > 32:
         return None
     if offset + 4 + num_handlers * 4 >= len(rom):
         return None
 
-    handlers = struct.unpack_from("<" + "L" * num_handlers, rom, offset + 4)
-    for handler_address in handlers:
+    # cheap reject on the first and the last entry before unpacking the whole table
+    for handler_offset in (offset + 4, offset + num_handlers * 4):
+        handler_address = struct.unpack_from("<L", rom, handler_offset)[0]
         if not is_rom_address(handler_address) or handler_address % 4 != 0:
             return None
 
-        handler_offset = to_offset(handler_address)
-        if handler_offset + 4 >= len(rom):
-            return None
-
-        if struct.unpack_from("<L", rom, handler_offset)[0] == 0:
-            continue
+    # Overlapping candidates and songs of the same game share handlers, so
+    # the validation of each handler address is done once per scan.
+    if handler_cache is None:
+        handler_cache = {}
 
-        handler_fields = struct.unpack_from("<LLLLLLL", rom, handler_offset)
-        if not is_rom_address(handler_fields[0]) or not is_rom_address(handler_fields[1]) or not is_rom_address(handler_fields[2]): # mandatory function pointers
-            return None
-        num_linked_handlers = handler_fields[3]
-        if num_linked_handlers > 255:
+    handlers = struct.unpack_from("<" + "L" * num_handlers, rom, offset + 4)
+    for handler_address in handlers:
+        if handler_address not in handler_cache:
+            handler_cache[handler_address] = parse_gax_handler(rom, handler_address)
+        if handler_cache[handler_address] is None:
             return None
 
-    song_header_handler_address = handlers[1]
-    song_header_handler_offset = to_offset(song_header_handler_address)
-    song_header_handler_fields = struct.unpack_from("<LLLLLLL", rom, song_header_handler_offset)
+    song_header_handler_fields = handler_cache[handlers[1]]
+    if not song_header_handler_fields:
+        if to_offset(handlers[1]) + 0x1c > len(rom):
+            return None
+        song_header_handler_fields = struct.unpack_from("<LLLLLLL", rom, to_offset(handlers[1]))
     song_header_address = song_header_handler_fields[6]
     if not is_rom_address(song_header_address) or song_header_address % 4 != 0:
         return None
@@ -195,10 +225,16 @@ def gax_scan(filename):
     with open(filename, "rb") as f:
         rom = f.read()
 
-        for offset in range(0, len(rom), 4):
+        # data is searched up to the padding (plus room for a header ending in fill bytes),
+        # pointers may still refer to anything in the file
+        padding_offset, padding_byte = find_padding(rom)
+        search_end = min(padding_offset + PADDING_MARGIN, len(rom))
+
+        for offset in range(0, search_end, 4):
             version = parse_gax_version(rom, offset)
             if version:
-                gax = {"version": version, "music": {}, "function": {}}
+                gax = {"version": version, "music": {}, "function": {},
+                       "padding": {"address": to_address(padding_offset), "size": len(rom) - padding_offset, "byte": padding_byte}}
                 break
 
         if not gax:
@@ -208,57 +244,21 @@ def gax_scan(filename):
             return gax
 
         if version["major_version"] == 3:
-            for offset in range(0, len(rom), 4):
+            for offset in range(0, search_end, 4):
                 song_header = parse_gax_music_v3(rom, offset)
                 if song_header:
                     gax["music"][to_address(offset)] = song_header
 
-            gax2_estimate_offset = rom.find(b'\xf0\xb5\x57\x46\x4e\x46\x45\x46\xe0\xb4\x82\xb0\x07\x1c\x00\x24\x00\x20\x00\x90')
-            if gax2_estimate_offset != -1:
-                gax["function"]["gax2_estimate"] = {"address": to_address(gax2_estimate_offset)}
-
-            gax2_new_offset = rom.find(b'\xf0\xb5\x47\x46\x80\xb4\x81\xb0\x06\x1c\x00\x2e')
-            if gax2_new_offset != -1:
-                gax["function"]["gax2_new"] = {"address": to_address(gax2_new_offset)}
-
-            gax2_init_offset = rom.find(b'\xf0\xb5\x57\x46\x4e\x46\x45\x46\xe0\xb4\x81\xb0\x07\x1c\x00\x26\x0e\x48\x39\x68\x01\x60')
-            if gax2_init_offset == -1:
-                gax2_init_offset = rom.find(b'\xf0\xb5\x57\x46\x4e\x46\x45\x46\xe0\xb4\x81\xb0\x07\x1c\x00\x22\x0e\x48\x39\x68') # 3.05-ND
-            if gax2_init_offset != -1:
-                gax["function"]["gax2_init"] = {"address": to_address(gax2_init_offset)}
-
-            gax2_jingle_offset = rom.find(b'\xf0\xb5\x47\x46\x80\xb4\x81\xb0\x80\x46\x0d\x48\x01\x68\x08\x1c\x80\x30\x8c\x6f\x04\x60\x04\x30\xcb\x6f\x03\x60\x4a\x68\xd1\x89')
-            if gax2_jingle_offset != -1:
-                gax["function"]["gax2_jingle"] = {"address": to_address(gax2_jingle_offset)}
-
-            gax_irq_offset = rom.find(b'\xf0\xb5\x3b\x48\x02\x68\x11\x68\x3a\x48\x81\x42\x6d\xd1\x50\x6d\x00\x28\x6a\xd0\x50\x6d\x01\x28\x1a\xd1\x02\x20\x50\x65\x36\x49')
-            if gax_irq_offset == -1:
-                gax_irq_offset = rom.find(b'\xf0\xb5\x33\x48\x03\x68\x1a\x68\x32\x49\x07\x1c\x8a\x42\x5b\xd1\x58\x6d\x00\x28\x58\xd0\x58\x6d\x01\x28\x1a\xd1\x02\x20\x58\x65') # 3.05-ND
-            if gax_irq_offset != -1:
-                gax["function"]["gax_irq"] = {"address": to_address(gax_irq_offset)}
-
-            gax_play_offset = rom.find(b'\x70\xb5\x81\xb0\x47\x48\x01\x68\x48\x6d\x00\x28\x00\xd1')
-            if gax_play_offset != -1:
-                gax["function"]["gax_play"] = {"address": to_address(gax_play_offset)}
-
-            gax_fx_offset = rom.find(b'\xf0\xb5\x07\x1c\x00\x25\x1c\x4c\xff\x2f\x39\xd8\x00\x22\x1b\x48\x01\x68\x0b\x69\x06\x1c\x9d\x42\x09\xd2\xc8\x68\x01\x6c\xa1\x42')
-            if gax_fx_offset != -1:
-                gax["function"]["gax_fx"] = {"address": to_address(gax_fx_offset)}
-
-            gax2_fx_offset = rom.find(b'\xf0\xb5\x04\x1c\x00\x2c\x09\xd1\x02\x48\x03\x49')
-            if gax2_fx_offset == -1:
-                gax2_fx_offset = rom.find(b'\xf0\xb5\x01\x1c\x00\x29\x35\xd0\x0f\x88\x48\x88\x16\x4a\x01\x23\x5b\x42\x9c\x46\x90\x42\x00\xd0\x84\x46\x48\x68\x01\x25\x6d\x42') # 3.05-ND
-            if gax2_fx_offset != -1:
-                gax["function"]["gax2_fx"] = {"address": to_address(gax2_fx_offset)}
-
-            gax2_new_fx_offset = rom.find(b'\x00\xb5\x01\x1c\x00\x29\x09\xd1\x02\x48\x03\x49')
-            if gax2_new_fx_offset == -1:
-                gax2_new_fx_offset = rom.find(b'\x01\x1c\x00\x29\x07\xd0\x04\x48\x08\x80\x01\x20\x40\x42\x48\x80\x48\x60\x88\x60\x88\x81\x70\x47\xff\xff\x00\x00') # 3.05-ND
-            if gax2_new_fx_offset != -1:
-                gax["function"]["gax2_new_fx"] = {"address": to_address(gax2_new_fx_offset)}
+            for function in SIGNATURES["signatures"]["gax"]:
+                if function == "version":
+                    continue
+                function_offset, _ = find_signature(rom, SIGNATURES, "gax", function, end=search_end)
+                if function_offset != -1:
+                    gax["function"][function] = {"address": to_address(function_offset)}
         else: # GAX V2
-            for offset in range(0, len(rom), 4):
-                song_header = parse_gax_music_v2(rom, offset)
+            handler_cache = {}
+            for offset in range(0, search_end, 4):
+                song_header = parse_gax_music_v2(rom, offset, handler_cache)
                 if song_header:
                     gax["music"][to_address(offset)] = song_header
 
@@ -267,20 +267,35 @@ def gax_scan(filename):
 
 def main():
     parser = argparse.ArgumentParser(description="Data Scanner for Shin'en GAX Sound Engine")
-    parser.add_argument('filename', help='GBA ROM to be parsed')
+    parser.add_argument('filenames', nargs='+', help='GBA ROM to be parsed')
+    parser.add_argument('--shard', type=parse_shard, metavar='i/N',
+                        help='scan only the i-th of N byte-balanced shards (0-based), prefixing each line with '
+                             'its input index so that shard outputs merge with "sort -s -n -k1,1 | cut -f2-"')
     args = parser.parse_args()
 
-    gax = gax_scan(args.filename)
-    if gax:
-        print("GAX Sound Engine " + gax["version"]["text"])
-        print("%d songs" % len(gax["music"]))
-        for address, header in gax["music"].items():
-            print("%08X %s" % (address, header["info"]))
-
-        if gax["function"]:
-            print()
-            for name, fn in gax["function"].items():
-                print("%-15s %08X" % (name, fn["address"]))
+    filenames = list(expand_patterns(args.filenames))
+    entries = shard_filenames(filenames, *args.shard) if args.shard else enumerate(filename for filename, _ in filenames)
+    for index, filename in entries:
+        lines = []
+        if len(filenames) > 1:
+            lines.append("# " + filename)
+
+        gax = gax_scan(filename)
+        if gax:
+            lines.append("GAX Sound Engine " + gax["version"]["text"])
+            if gax["padding"]["size"]:
+                lines.append("padding %02X from %08X, %d bytes" % (gax["padding"]["byte"], gax["padding"]["address"], gax["padding"]["size"]))
+            lines.append("%d songs" % len(gax["music"]))
+            for address, header in gax["music"].items():
+                lines.append("%08X %s" % (address, header["info"]))
+
+            if gax["function"]:
+                lines.append("")
+                for name, fn in gax["function"].items():
+                    lines.append("%-15s %08X" % (name, fn["address"]))
+
+        for line in lines:
+            print("%d\t%s" % (index, line) if args.shard else line)
 
 
 main()
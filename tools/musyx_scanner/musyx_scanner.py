@@ -1,5 +1,13 @@
 import argparse
+import array
 import os
+import struct
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".."))
+from agbsignatures import PADDING_MARGIN, expand_patterns, find_padding, find_signature, load_signatures, parse_shard, shard_filenames
+
+SIGNATURES = load_signatures()
 
 
 def is_rom_address(address):
@@ -14,6 +22,108 @@ def to_offset(address):
     return address - 0x8000000
 
 
+def find_thumb_calls(rom, target_offset, search_end=None):
+    # The first halfword of bl carries bits 22-12 of the displacement, so it is the same
+    # for every call site within a 4KB window: one bounded find per window covers the
+    # whole +-4MB reach of bl instead of decoding every halfword of the ROM.
+    search_end = len(rom) if search_end is None else search_end
+    calls = []
+    for window in range(-0x400, 0x400):
+        last = target_offset - 4 - window * 0x1000
+        first = max(last - 0xfff, 0)
+        if last < 0 or first >= search_end:
+            continue
+
+        high = struct.pack("<H", 0xf000 | (window & 0x7ff))
+        offset = rom.find(high, first, min(last + 2, search_end))
+        while offset != -1:
+            displacement = target_offset - 4 - offset
+            if offset % 2 == 0 and rom[offset + 2:offset + 4] == struct.pack("<H", 0xf800 | ((displacement >> 1) & 0x7ff)):
+                calls.append(offset)
+            offset = rom.find(high, offset + 1, min(last + 2, search_end))
+    return sorted(calls)
+
+
+def find_literal_argument(rom, call_offset, register, max_distance=0x20):
+    # closest ldr rX, [pc, #imm] before the call
+    for offset in range(call_offset - 2, max(call_offset - max_distance, 0) - 2, -2):
+        if rom[offset + 1] == 0x48 | register:
+            literal_offset = ((offset + 4) & ~3) + rom[offset] * 4
+            if literal_offset + 4 <= len(rom):
+                return struct.unpack_from("<L", rom, literal_offset)[0]
+            return None
+    return None
+
+
+def is_data_pointer(rom, address):
+    return is_rom_address(address) and address % 4 == 0 and to_offset(address) < len(rom)
+
+
+# a ROM pointer has 0x08 or 0x09 in its high byte and a 4-byte aligned low byte
+POINTER_HIGH_TABLE = bytes(1 if byte in (0x08, 0x09) else 0 for byte in range(256))
+POINTER_LOW_TABLE = bytes(1 if byte % 4 == 0 else 0 for byte in range(256))
+
+
+def count_valid(flags):
+    index = flags.find(0)
+    return len(flags) if index == -1 else index
+
+
+def parse_pointer_table(rom, address, max_entries=0x400):
+    # All candidate words are checked at once: the high and low bytes through translate
+    # tables, then the range by the largest address, instead of one test per word.
+    offset = to_offset(address)
+    count = min(max_entries, (len(rom) - offset) // 4)
+    data = rom[offset:offset + count * 4]
+    length = min(count_valid(data[3::4].translate(POINTER_HIGH_TABLE)),
+                 count_valid(data[0::4].translate(POINTER_LOW_TABLE)))
+
+    words = array.array("I", data[:length * 4])
+    if sys.byteorder == "big":
+        words.byteswap()
+    limit = to_address(len(rom))
+    while words and max(words) >= limit:
+        words = words[:words.index(max(words))]
+    return list(words)
+
+
+def parse_musyx_data(rom, snd_init_offset, search_end=None):
+    for call_offset in find_thumb_calls(rom, snd_init_offset, search_end):
+        # snd_Init checks the alignment of three pointers in the structure passed in r1
+        config_address = find_literal_argument(rom, call_offset, 1)
+        if config_address is None or not is_data_pointer(rom, config_address) or to_offset(config_address) + 12 > len(rom):
+            continue
+        addresses = struct.unpack_from("<LLL", rom, to_offset(config_address))
+        if not all(is_data_pointer(rom, address) for address in addresses):
+            continue
+
+        # The names follow the order of the checks in snd_Init, the layout of each block
+        # is inferred: a block starting with ROM pointers is treated as a table of entries.
+        data = {}
+        for name, address in zip(("song_groups", "sample_directory", "pool_data"), addresses):
+            data[name] = {"address": address, "entries": [{"address": entry} for entry in parse_pointer_table(rom, address)]}
+
+        # A table block takes 4 bytes per entry, any other size is estimated from the distance
+        # to the next known address, and an entry never extends into the next block.
+        boundaries = sorted(set(addresses) | {entry["address"] for block in data.values() for entry in block["entries"]})
+        next_addresses = dict(zip(boundaries, boundaries[1:]))
+        for block in data.values():
+            block_address = block["address"]
+            next_address = next_addresses.get(block_address)
+            block["size"] = len(block["entries"]) * 4 if block["entries"] else \
+                (next_address - block_address if next_address else None)
+            for entry in block["entries"]:
+                limits = [address for address in addresses if address > entry["address"]]
+                if entry["address"] in next_addresses:
+                    limits.append(next_addresses[entry["address"]])
+                entry["size"] = min(limits) - entry["address"] if limits else None
+
+        data["call"] = {"address": to_address(call_offset), "config_address": config_address}
+        data["estimated"] = True
+        return data
+    return None
+
+
 def musyx_scan(filename):
     size = os.path.getsize(filename)
     if size < 0xc0 or size > 0x2000000:
@@ -23,63 +133,73 @@ def musyx_scan(filename):
     with open(filename, "rb") as f:
         rom = f.read()
 
+        # functions are searched up to the padding, pointers may still refer to anything in the file
+        padding_offset, padding_byte = find_padding(rom)
+        search_end = min(padding_offset + PADDING_MARGIN, len(rom))
+
         # Library version detection may improve scanning speed, but is not planned for now.
 
-        snd_init_offset = rom.find(b'\x70\xb5\x05\x1c\x0e\x1c\x30\x68\x03\x21\x08\x40\x00\x28\x00\xd0\xb4\xe0\x70\x68\x08\x40\x00\x28\x00\xd0\xaf\xe0\xb0\x68\x08\x40')
-        if snd_init_offset == -1:
-            snd_init_offset = rom.find(b'\xf0\xb5\x47\x46\x80\xb4\x05\x1c\x0e\x1c\x90\x46\x1f\x1c\x00\x2a\x00\xd1\xc1\xe0\x00\x2f\x00\xd1\xbe\xe0\x30\x68\x03\x21\x08\x40')
-        if snd_init_offset != -1:
-            musyx["function"]["snd_Init"] = {"address": to_address(snd_init_offset)}
-
-        snd_handle_intermediate_offset = rom.find(b'\x00\x20\x81\x46\x00\x24\x2a\x48\x03\x68\x4a\x46\x91\x00\x18\x1c\x18\x30\x42\x18\x11\x68\x40\x20\x08\x40\x00\x28\x19\xd0\x41\x20')
-        if snd_handle_intermediate_offset == -1:
-            snd_handle_intermediate_offset = rom.find(b'\x00\x20\x81\x46\x00\x24\x2A\x48\x03\x68\x4A\x46\x91\x00\x18\x1C\x10\x30\x42\x18\x11\x68\x40\x20\x08\x40\x00\x28\x18\xD0\x41\x20')
-        snd_handle_offset = snd_handle_intermediate_offset - 0x2c if snd_handle_intermediate_offset >= 0x2c else -1
-        if snd_handle_offset != -1:
-            musyx["function"]["snd_Handle"] = {"address": to_address(snd_handle_offset)}
-
-        snd_do_sample_offset = rom.find(b'\xf0\xb5\x57\x46\x4e\x46\x45\x46\xe0\xb4\x85\xb0\x31\x4e\x35\x68\x28\x78\x00\x28\x00\xd1\xaa\xe0\x2f\x1c\xd0\x37\x38\x68\x00\x90')
-        if snd_do_sample_offset == -1:
-            snd_do_sample_offset = rom.find(b'\xf0\xb5\x57\x46\x4e\x46\x45\x46\xe0\xb4\x85\xb0\x36\x4d\x2c\x68\x20\x78\x00\x28\x00\xd1\xb4\xe0\x27\x1c\xd0\x37\x38\x68\x00\x90')
-            if snd_do_sample_offset == -1:
-                snd_do_sample_offset = rom.find(b'\xf0\xb5\x57\x46\x4e\x46\x45\x46\xe0\xb4\x85\xb0\x36\x4d\x2c\x68\x20\x7a\x00\x28\x00\xd1\xb4\xe0\x27\x1c\xd8\x37\x38\x68\x00\x90')
-        if snd_do_sample_offset != -1:
-            musyx["function"]["snd_DoSample"] = {"address": to_address(snd_do_sample_offset)}
-
-        snd_start_song_offset = rom.find(b'\xf0\xb5\x57\x46\x4e\x46\x45\x46\xe0\xb4\x05\x1c\x39\x4a\x13\x68\x88\x21\x49\x00\x58\x18\x00\x68\x81\x69\x40\x18\x00\x68\xa8\x42')
-        if snd_start_song_offset == -1:
-            snd_start_song_offset = rom.find(b'\xf0\xb5\x57\x46\x4e\x46\x45\x46\xe0\xb4\x04\x1c\x3a\x4a\x13\x68\x8c\x21\x49\x00\x58\x18\x00\x68\x81\x69\x40\x18\x00\x68\xa0\x42')
-        if snd_start_song_offset != -1:
-            musyx["function"]["snd_StartSong"] = {"address": to_address(snd_start_song_offset)}
-
-        snd_resume_song_offset = rom.find(b'\x06\x48\x00\x68\x8c\x21\x49\x00\x40\x18\x00\x68\x39\x31\x42\x18\x11\x78\x01\x29\x04\xd0\x00\x20\x06\xe0\x00\x00')
-        if snd_resume_song_offset == -1:
-            snd_resume_song_offset = rom.find(b'\x06\x48\x00\x68\x90\x21\x49\x00\x40\x18\x00\x68\x31\x31\x42\x18\x11\x78\x01\x29\x04\xd0\x00\x20\x06\xe0\x00\x00')
-            if snd_resume_song_offset == -1:
-                snd_resume_song_offset = rom.find(b'\x00\xb5\x06\x48\x00\x68\x90\x21\x49\x00\x40\x18\x00\x68\x31\x31\x42\x18\x11\x78\x01\x29\x03\xd0\x00\x20\x05\xe0')
-        if snd_resume_song_offset != -1:
-            musyx["function"]["snd_ResumeSong"] = {"address": to_address(snd_resume_song_offset)}
-
-        snd_get_sample_working_set_size_offset = rom.find(b'\xf0\xb5\x57\x46\x4e\x46\x45\x46\xe0\xb4\x82\xb0\x04\x1c\x0e\x1c\x00\x2e\x01\xd1\x00\x20\xdc\xe0\xa2\x78\x10\x01\x80\x18\x80\x00')
-        if snd_get_sample_working_set_size_offset != -1:
-            musyx["function"]["snd_GetSampleWorkingSetSize"] = {"address": to_address(snd_get_sample_working_set_size_offset)}
-
-    return musyx if musyx["function"] else None
+        for function in SIGNATURES["signatures"]["musyx"]:
+            function_offset, signature = find_signature(rom, SIGNATURES, "musyx", function, end=search_end)
+            if function_offset != -1:
+                musyx["function"][function] = {"address": to_address(function_offset - signature["entry_offset"])}
+
+        if "snd_Init" in musyx["function"]:
+            data = parse_musyx_data(rom, to_offset(musyx["function"]["snd_Init"]["address"]), search_end)
+            if data:
+                musyx["data"] = data
+
+    if musyx["function"]:
+        musyx["padding"] = {"address": to_address(padding_offset), "size": len(rom) - padding_offset, "byte": padding_byte}
+        return musyx
+    return None
+
+
+def format_size(size):
+    return "%8d bytes" % size if size is not None else "       ? bytes"
 
 
 def main():
     parser = argparse.ArgumentParser(description="Scanner for Factor 5 MusyX Engine (GBA)")
-    parser.add_argument('filename', help='GBA ROM to be parsed')
+    parser.add_argument('filenames', nargs='+', help='GBA ROM to be parsed')
+    parser.add_argument('--shard', type=parse_shard, metavar='i/N',
+                        help='scan only the i-th of N byte-balanced shards (0-based), prefixing each line with '
+                             'its input index so that shard outputs merge with "sort -s -n -k1,1 | cut -f2-"')
     args = parser.parse_args()
 
-    musyx = musyx_scan(args.filename)
-    if musyx:
-        print("MusyX for GBA")
-
-        if musyx["function"]:
-            print()
-            for name, fn in musyx["function"].items():
-                print("%-15s %08X" % (name, fn["address"]))
+    filenames = list(expand_patterns(args.filenames))
+    entries = shard_filenames(filenames, *args.shard) if args.shard else enumerate(filename for filename, _ in filenames)
+    for index, filename in entries:
+        lines = []
+        if len(filenames) > 1:
+            lines.append("# " + filename)
+
+        musyx = musyx_scan(filename)
+        if musyx:
+            lines.append("MusyX for GBA")
+            if musyx["padding"]["size"]:
+                lines.append("padding %02X from %08X, %d bytes" % (musyx["padding"]["byte"], musyx["padding"]["address"], musyx["padding"]["size"]))
+
+            if musyx["function"]:
+                lines.append("")
+                for name, fn in musyx["function"].items():
+                    lines.append("%-15s %08X" % (name, fn["address"]))
+
+            if "data" in musyx:
+                data = musyx["data"]
+                lines.append("")
+                lines.append("snd_Init call   %08X (config %08X)" % (data["call"]["address"], data["call"]["config_address"]))
+                lines.append("estimated layout: block names follow the order of the checks in snd_Init, "
+                             "entries are runs of ROM pointers, other sizes are gaps to the next known address "
+                             "up to the next block")
+                for name in ("song_groups", "sample_directory", "pool_data"):
+                    block = data[name]
+                    lines.append("%-16s %08X %s %d entries" % (name, block["address"], format_size(block["size"]), len(block["entries"])))
+                    for number, entry in enumerate(block["entries"]):
+                        lines.append("  %4d %08X %s" % (number, entry["address"], format_size(entry["size"])))
+
+        for line in lines:
+            print("%d\t%s" % (index, line) if args.shard else line)
 
 
 main()
@@ -0,0 +1,230 @@
+import argparse
+import glob
+import itertools
+import json
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".."))
+from agbsignatures import find_padding
+
+
+def to_address(offset):
+    return 0x8000000 + offset
+
+
+def read_rom(filename):
+    size = os.path.getsize(filename)
+    if size < 0xc0 or size > 0x2000000:
+        raise ValueError("Input too small/large")
+
+    with open(filename, "rb") as f:
+        rom = f.read()
+
+    # trailing padding never holds a driver, and it would only produce uniform runs
+    padding_offset, _ = find_padding(rom)
+    return rom[:padding_offset]
+
+
+def sample_grams(rom, gram_length, step):
+    # Every common run of (gram_length + step - 1) bytes or more contains
+    # at least one gram that starts at a multiple of step.
+    grams = set()
+    for offset in range(0, len(rom) - gram_length + 1, step):
+        gram = rom[offset:offset + gram_length]
+        if gram.count(gram[0]) != gram_length:
+            grams.add(gram)
+    return grams
+
+
+# below this many grams, one C-level substring search per gram beats walking every offset
+FILTER_DIRECT_LIMIT = 256
+
+
+def filter_grams(grams, rom, gram_length):
+    if len(grams) <= FILTER_DIRECT_LIMIT:
+        return {gram for gram in grams if gram in rom}
+
+    # bytes slicing and hashing run in C, which beats a rolling hash updated from Python
+    found = set()
+    for offset in range(len(rom) - gram_length + 1):
+        gram = rom[offset:offset + gram_length]
+        if gram in grams:
+            found.add(gram)
+            if len(found) == len(grams):
+                break
+    return found
+
+
+def is_common(data, positives, negatives):
+    return all(data in rom for rom in positives) and not any(data in rom for rom in negatives)
+
+
+def merge_seeds(reference, grams, gram_length, step):
+    runs = []
+    start = end = None
+    for offset in range(0, len(reference) - gram_length + 1, step):
+        if reference[offset:offset + gram_length] not in grams:
+            continue
+
+        if end is not None and offset == end - gram_length + step:
+            end = offset + gram_length
+        else:
+            if start is not None:
+                runs.append((start, end))
+            start, end = offset, offset + gram_length
+    if start is not None:
+        runs.append((start, end))
+    return runs
+
+
+def longest_prefix(reference, positives, start, low, high):
+    # reference[start:low] is known to be common; find the largest end that keeps it so
+    while low < high:
+        middle = (low + high + 1) // 2
+        if all(reference[start:middle] in rom for rom in positives):
+            low = middle
+        else:
+            high = middle - 1
+    return low
+
+
+def split_run(reference, positives, start, end, gram_length, step):
+    # every sampled gram is common, but their concatenation may not be
+    if all(reference[start:end] in rom for rom in positives):
+        return [(start, end)]
+
+    runs = []
+    while start + gram_length <= end:
+        run_end = longest_prefix(reference, positives, start, start + gram_length, end)
+        runs.append((start, run_end))
+        start += step
+        while start + gram_length <= end and start < run_end - gram_length + 1:
+            start += step
+    return runs
+
+
+def extend_run(reference, positives, negatives, start, end, step):
+    low = max(0, start - step + 1)
+    while low < start:
+        middle = (low + start) // 2
+        if is_common(reference[middle:end], positives, negatives):
+            start = middle
+        else:
+            low = middle + 1
+
+    high = min(len(reference), end + step - 1)
+    return start, longest_prefix(reference, positives, start, end, high)
+
+
+def mine_signatures(positives, negatives, min_length, top):
+    gram_length = max(4, min_length // 2)
+    step = min_length - gram_length + 1
+
+    reference = min(positives, key=len)
+    others = [rom for rom in positives if rom is not reference]
+
+    grams = sample_grams(reference, gram_length, step)
+    for rom in others:
+        grams = filter_grams(grams, rom, gram_length)
+        if not grams:
+            return []
+
+    runs = []
+    for start, end in merge_seeds(reference, grams, gram_length, step):
+        for run_start, run_end in split_run(reference, others, start, end, gram_length, step):
+            if run_end - run_start >= min_length and not any(reference[run_start:run_end] in rom for rom in negatives):
+                runs.append((run_start, run_end))
+
+    runs.sort(key=lambda run: (run[0] - run[1], run[0]))
+    signatures = []
+    for start, end in runs[:top]:
+        start, end = extend_run(reference, others, negatives, start, end, step)
+        pattern = reference[start:end]
+        signatures.append({
+            "pattern": pattern,
+            "offsets": [rom.find(pattern) for rom in positives]
+        })
+
+    # extension can make two neighbouring runs collapse into the same one
+    unique = {}
+    for signature in signatures:
+        unique.setdefault(signature["pattern"], signature)
+    return sorted(unique.values(), key=lambda signature: -len(signature["pattern"]))
+
+
+def select_window(pattern, negatives, length):
+    if len(pattern) <= length:
+        return pattern
+
+    # Thumb code is halfword aligned, so prefer aligned windows
+    for start in range(0, len(pattern) - length + 1, 2):
+        window = pattern[start:start + length]
+        if not any(window in rom for rom in negatives):
+            return window
+    return pattern
+
+
+def format_bytes(data):
+    return "b'" + "".join("\\x%02x" % byte for byte in data) + "'"
+
+
+def expand_filenames(patterns):
+    return list(itertools.chain.from_iterable(glob.iglob(pattern) for pattern in patterns))
+
+
+def parse_min_length(text):
+    # shorter runs leave no room for a sampling step of at least one byte
+    value = int(text)
+    if value < 4:
+        raise argparse.ArgumentTypeError("must be at least 4")
+    return value
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Propose sound driver signatures from GBA ROMs sharing a driver")
+    parser.add_argument('-p', '--positive', nargs='+', required=True, help='GBA ROMs known to use the driver')
+    parser.add_argument('-n', '--negative', nargs='*', default=[], help='GBA ROMs known not to use the driver')
+    parser.add_argument('--min-length', type=parse_min_length, default=32, help='shortest byte run to report')
+    parser.add_argument('--max-length', type=parse_min_length, default=32, help='length of the proposed signature')
+    parser.add_argument('--top', type=int, default=10, help='number of byte runs to report')
+    parser.add_argument('--name', default='new_driver', help='driver name used for the proposed scanner')
+    args = parser.parse_args()
+
+    positive_filenames = expand_filenames(args.positive)
+    negative_filenames = expand_filenames(args.negative)
+    if not positive_filenames:
+        parser.error("no positive ROM found")
+
+    positives = [read_rom(filename) for filename in positive_filenames]
+    negatives = [read_rom(filename) for filename in negative_filenames]
+
+    signatures = mine_signatures(positives, negatives, args.min_length, args.top)
+    if not signatures:
+        print("No common byte run found")
+        return
+
+    for index, signature in enumerate(signatures):
+        print("#%d: %d bytes" % (index + 1, len(signature["pattern"])))
+        print("    " + format_bytes(signature["pattern"]))
+        for filename, offset in zip(positive_filenames, signature["offsets"]):
+            print("    %08X %s" % (to_address(offset), os.path.basename(filename)))
+
+    pattern = select_window(signatures[0]["pattern"], negatives, args.max_length)
+    driver = "".join(c if c.isalnum() else "_" for c in args.name.lower())
+    entry = {"driver": driver, "function": "driver", "pattern": " ".join("%02x" % byte for byte in pattern)}
+    print()
+    print("# signatures.json")
+    print(json.dumps(entry) + ",")
+    print()
+    print("def agbinator_scan_%s(rom):" % driver)
+    print("    if not has_signature(rom, SIGNATURES, \"%s\", \"driver\"):" % driver)
+    print("        return None")
+    print()
+    print("    return {")
+    print("        \"driver_name\": \"%s\"," % args.name)
+    print("        \"driver_version\": \"\"")
+    print("    }")
+
+
+main()
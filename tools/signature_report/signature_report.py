@@ -0,0 +1,123 @@
+import argparse
+import multiprocessing
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", ".."))
+
+import agbinator
+import agbsignatures
+
+
+def signature_names():
+    # one column per variant, e.g. kcej.driver[1] for the second kcej driver pattern
+    names = []
+    for driver, functions in agbinator.SIGNATURES["signatures"].items():
+        for function, signatures in functions.items():
+            for index, signature in enumerate(signatures):
+                name = "%s.%s" % (driver, function)
+                names.append((name + "[%d]" % index if len(signatures) > 1 else name, signature))
+    return names
+
+
+class CachedRom:
+    # Stands in for the ROM bytes like agbinator.HintedRom: every distinct find/search
+    # runs once, so the signatures the scanners already looked up cost nothing when
+    # the report checks all of them afterwards.
+
+    def __init__(self, rom):
+        self.rom = rom
+        self.results = {}
+
+    def __len__(self):
+        return len(self.rom)
+
+    def __getitem__(self, key):
+        return self.rom[key]
+
+    def find(self, sub, start=0, end=None):
+        key = ("find", sub, start, end)
+        if key not in self.results:
+            self.results[key] = self.rom.find(sub, start, end)
+        return self.results[key]
+
+    def search(self, pattern):
+        key = ("search", pattern)
+        if key not in self.results:
+            self.results[key] = pattern.search(self.rom)
+        return self.results[key]
+
+
+def match_any(rom, signature):
+    if "regex" in signature:
+        return rom.search(agbsignatures.signature_regex(signature)) is not None
+    return agbsignatures.match_signature(rom, signature) != -1
+
+
+def scan_all(filename):
+    try:
+        _, rom = agbinator.read_scanned_rom(filename)
+    except (OSError, ValueError) as e:
+        return filename, None, None, str(e)
+
+    # the driver agbinator() would report, next to every signature that matches
+    rom = CachedRom(rom)
+    match_result = agbinator.agbinator_scan(rom)
+    hits = [(name, signature["driver"]) for name, signature in signature_names() if match_any(rom, signature)]
+    return filename, match_result["driver_name"] if match_result else "", hits, None
+
+
+def report(filenames, processes):
+    names = [name for name, _ in signature_names()]
+    matrix = {}
+    conflicts = []
+    fired = set()
+    num_roms = 0
+
+    with multiprocessing.Pool(processes) as pool:
+        for filename, driver_name, hits, error in pool.imap_unordered(scan_all, filenames, chunksize=4):
+            if error is not None:
+                print("%s: %s" % (filename, error), file=sys.stderr)
+                continue
+
+            num_roms += 1
+            row = matrix.setdefault(driver_name, {})
+            for name, _ in hits:
+                row[name] = row.get(name, 0) + 1
+                fired.add(name)
+
+            # signatures of several drivers in one ROM
+            if len({driver for _, driver in hits}) > 1:
+                conflicts.append((filename, hits))
+
+    print("%d ROMs" % num_roms)
+    print()
+    print("\t".join(["driver"] + names))
+    for driver_name in sorted(matrix):
+        row = matrix[driver_name]
+        print("\t".join([driver_name or "(none)"] + [str(row.get(name, 0)) for name in names]))
+
+    print()
+    print("%d conflicts" % len(conflicts))
+    for filename, hits in sorted(conflicts):
+        print("%s\t%s" % (filename, "\t".join(name for name, _ in hits)))
+
+    print()
+    print("Never fired")
+    for name in names:
+        if name not in fired:
+            print(name)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Report signature collisions and coverage over a GBA ROM corpus.")
+    parser.add_argument('filenames', nargs='+', help='GBA ROMs to be scanned, directories are walked recursively')
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count(), help='number of worker processes')
+    args = parser.parse_args()
+
+    filenames = [filename for filename, _ in agbinator.expand_filenames(args.filenames, ['*.gba'], [])]
+    report(filenames, args.jobs)
+
+
+if __name__ == "__main__":
+    main()